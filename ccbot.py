@@ -1,23 +1,105 @@
 import discord
 from discord.ext import commands
 import os
+import sys
 import asyncio
 import uuid
 import re
 import shutil
 import time
+import heapq
+import math
+import collections
 from pathlib import Path
 from datetime import datetime
 from dotenv import load_dotenv
-from openai import OpenAI
-import requests
+from openai import AsyncOpenAI
+import aiohttp
 import csv
+import json
+import sqlite3
+import threading
 import io
+import contextlib
+import copy
+import contextvars
+import hashlib
+import html
 import logging
-from logging.handlers import RotatingFileHandler
+import queue
+import atexit
+import base64
+import bisect
+import gzip
+import mimetypes
+from urllib.parse import urlparse
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+from jinja2 import Environment
+from fastapi import FastAPI, Request
+from fastapi.responses import PlainTextResponse, FileResponse, RedirectResponse, Response, JSONResponse
+import uvicorn
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 load_dotenv()
 
+LOG_ASYNC = os.getenv('LOG_ASYNC', 'true').lower() in ('1', 'true', 'yes')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+log_listeners = []
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line for the detailed log file"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'func': record.funcName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class ExcInfoQueueHandler(QueueHandler):
+    """QueueHandler that keeps exc_info on the queued record
+
+    The stock prepare() folds the traceback into msg and drops exc_info,
+    which would lose JsonFormatter's exc field. Records stay in-process,
+    so the traceback objects can be passed to the listener thread as-is.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def queue_handler_for(*handlers):
+    """Wrap handlers so records are written by a background listener thread
+
+    The event loop only enqueues records; file writes and rotation happen
+    on the listener thread. With LOG_ASYNC disabled the handlers are used
+    directly.
+    """
+    if not LOG_ASYNC:
+        return list(handlers)
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    log_listeners.append(listener)
+    return [ExcInfoQueueHandler(log_queue)]
+
+def stop_log_listeners():
+    """Flush queued records on shutdown"""
+    while log_listeners:
+        log_listeners.pop().stop()
+
+atexit.register(stop_log_listeners)
+
 def setup_logging():
     """Setup comprehensive logging with file output and console output"""
     logs_dir = Path('./logs')
@@ -32,10 +114,13 @@ def setup_logging():
         encoding='utf-8'
     )
     file_handler.setLevel(logging.DEBUG)
-    file_formatter = logging.Formatter(
-        '%(asctime)s | %(levelname)-8s | %(funcName)-25s | %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
+    if LOG_FORMAT == 'json':
+        file_formatter = JsonFormatter()
+    else:
+        file_formatter = logging.Formatter(
+            '%(asctime)s | %(levelname)-8s | %(funcName)-25s | %(message)s',
+            datefmt='%Y-%m-%d %H:%M:%S'
+        )
     file_handler.setFormatter(file_formatter)
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
@@ -44,16 +129,220 @@ def setup_logging():
         datefmt='%H:%M:%S'
     )
     console_handler.setFormatter(console_formatter)
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    for handler in queue_handler_for(file_handler, console_handler):
+        logger.addHandler(handler)
     return logger
 
 logger = setup_logging()
 
 def log_info(msg):
     """Log to both console and file"""
-    print(msg)
-    logger.info(msg)
+    logger.info(msg, stacklevel=2)
+
+class Metric:
+    """Base for the small in-process Prometheus metrics below"""
+
+    def __init__(self, name, help_text, metric_type, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.metric_type = metric_type
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        metrics_registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labelnames)
+
+    def _format_labels(self, key, extra=None):
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ''
+        escaped = []
+        for label, value in pairs:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            escaped.append(f'{label}="{value}"')
+        return '{' + ','.join(escaped) + '}'
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} {self.metric_type}']
+        for key, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{self._format_labels(key)} {value}')
+        return lines
+
+class Counter(Metric):
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, 'counter', labelnames)
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """Gauge whose value is read from a callback at scrape time"""
+
+    def __init__(self, name, help_text, callback):
+        super().__init__(name, help_text, 'gauge')
+        self.callback = callback
+
+    def render(self):
+        self.values = {(): self.callback()}
+        return super().render()
+
+class Histogram(Metric):
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, 'histogram', labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts, total, observed = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key] = (counts, total + value, observed + 1)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for key, (counts, total, observed) in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": bound})} {count}')
+            lines.append(f'{self.name}_bucket{self._format_labels(key, {"le": "+Inf"})} {observed}')
+            lines.append(f'{self.name}_sum{self._format_labels(key)} {total}')
+            lines.append(f'{self.name}_count{self._format_labels(key)} {observed}')
+        return lines
+
+def render_metrics():
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in metrics_registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+metrics_registry = []
+active_subprocesses = set()
+STAGE_DURATION = Histogram('ccbot_stage_duration_seconds', 'Duration of each !claude pipeline stage', ['stage'])
+JOBS_TOTAL = Counter('ccbot_jobs_total', 'Finished !claude jobs by outcome', ['status'])
+OPENAI_DURATION = Histogram('ccbot_openai_request_duration_seconds', 'OpenAI API request latency', ['operation'])
+OPENAI_ERRORS = Counter('ccbot_openai_errors_total', 'Failed OpenAI API requests', ['operation'])
+DISCORD_SEND_DURATION = Histogram('ccbot_discord_send_duration_seconds', 'Discord message send/edit latency', ['operation'])
+
+def count_active_subprocesses():
+    for process in [p for p in active_subprocesses if p.returncode is not None]:
+        active_subprocesses.discard(process)
+    return len(active_subprocesses)
+
+ACTIVE_SUBPROCESSES = Gauge('ccbot_active_subprocesses', 'Running child processes (Claude Code and !cmd)', count_active_subprocesses)
+
+TRACE_LOG_PATH = Path(os.getenv('TRACE_LOG_PATH', './logs/traces.jsonl'))
+current_span = contextvars.ContextVar('current_span', default=None)
+
+def setup_trace_logger():
+    """JSON-lines sink for finished spans"""
+    TRACE_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+    trace_logger = logging.getLogger('discord_bot.trace')
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+    trace_logger.handlers.clear()
+    handler = logging.FileHandler(TRACE_LOG_PATH, encoding='utf-8')
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    for queued_handler in queue_handler_for(handler):
+        trace_logger.addHandler(queued_handler)
+    return trace_logger
+
+trace_logger = setup_trace_logger()
+
+class Span:
+    """One timed section of a request; nested spans share the trace ID"""
+
+    def __init__(self, name, parent=None, trace_id=None, **attributes):
+        self.name = name
+        self.trace_id = trace_id or (parent.trace_id if parent else uuid.uuid4().hex[:16])
+        self.span_id = uuid.uuid4().hex[:8]
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.started_at = time.time()
+
+    def to_json(self, duration, status):
+        return json.dumps({
+            'ts': datetime.fromtimestamp(self.started_at).isoformat(),
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'duration_ms': round(duration * 1000, 1),
+            'status': status,
+            **self.attributes
+        }, ensure_ascii=False, default=str)
+
+@contextlib.contextmanager
+def trace_span(name, trace_id=None, **attributes):
+    """Time a block as a child of the current span and emit it as a JSON line"""
+    span = Span(name, parent=current_span.get(), trace_id=trace_id, **attributes)
+    token = current_span.set(span)
+    start = time.perf_counter()
+    status = 'ok'
+    try:
+        yield span
+    except BaseException as e:
+        status = 'cancelled' if isinstance(e, asyncio.CancelledError) else 'error'
+        span.attributes.setdefault('error', f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        current_span.reset(token)
+        trace_logger.info(span.to_json(time.perf_counter() - start, status))
+
+def annotate_span(**attributes):
+    """Attach attributes (PID, exit code, ...) to the innermost open span"""
+    span = current_span.get()
+    if span:
+        span.attributes.update(attributes)
+
+@contextlib.contextmanager
+def pipeline_stage(stage, **attributes):
+    """A pipeline stage: recorded in the stage histogram and as a trace span"""
+    with STAGE_DURATION.time(stage=stage), trace_span(stage, **attributes) as span:
+        yield span
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0
+    index = max(0, min(len(sorted_values) - 1, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def trace_report(path=TRACE_LOG_PATH, since=None):
+    """Aggregate span durations per stage into count / p50 / p95 / max"""
+    durations = {}
+    errors = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                span = json.loads(line)
+            except ValueError:
+                continue
+            if since and span.get('ts', '') < since:
+                continue
+            durations.setdefault(span['name'], []).append(span['duration_ms'] / 1000)
+            if span.get('status') != 'ok' or span.get('error'):
+                errors[span['name']] = errors.get(span['name'], 0) + 1
+    lines = [f"{'stage':<16} {'count':>6} {'errors':>6} {'p50(s)':>9} {'p95(s)':>9} {'max(s)':>9}"]
+    for name, values in sorted(durations.items(), key=lambda item: -sum(item[1])):
+        values.sort()
+        lines.append(
+            f"{name:<16} {len(values):>6} {errors.get(name, 0):>6} "
+            f"{percentile(values, 0.5):>9.2f} {percentile(values, 0.95):>9.2f} {values[-1]:>9.2f}"
+        )
+    return "\n".join(lines)
 
 def get_project_url(project_id):
     """Get project URL from project ID"""
@@ -61,59 +350,54 @@ def get_project_url(project_id):
         return f"{PROJECT_BASE_URL.rstrip('/')}/{project_id}"
     return f"/projects/{project_id}"
 
-async def generate_tags_with_ai(project_summary, prompt):
-    """Generate tags using AI by extracting keywords"""
-    if not openai_client:
-        return []
-    try:
-        system_prompt = """あなたはプロジェクトのタグ生成の専門家です。
-プロジェクトのサマリーとユーザーの指示から、検索やフィルタリングに適したキーワードをスペース区切りで生成してください。
-
-要件:
-- 3〜5個のキーワードを生成
-- 各キーワードは3〜15文字程度
-- 技術名、ジャンル、特徴を表すキーワード
-- スペース区切りで出力（カンマや記号は不要）
-
-例:
-入力: 「じゃんけんゲーム」「じゃんけんゲームを作って」
-出力: ゲーム じゃんけん JavaScript インタラクティブ
-
-入力: 「ToDoリスト管理アプリ」「ToDoアプリを作成」
-出力: ToDoリスト 管理アプリ タスク Web
-
-入力: 「レスポンシブなポートフォリオ」「ポートフォリオサイト作成」
-出力: ポートフォリオ レスポンシブ デザイン Web"""
-
-        user_prompt = f"""プロジェクトサマリー: {project_summary}
-ユーザーの指示: {prompt}
-
-このプロジェクトに適したキーワードをスペース区切りで生成してください。"""
-
-        response = await asyncio.wait_for(
-            asyncio.to_thread(
-                openai_client.chat.completions.create,
-                model="gpt-4o-mini",
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ],
-                max_tokens=50,
-                temperature=0.5
-            ),
-            timeout=15
-        )
+PIPELINE_DIR_NAME = '.pipeline'
+SCAN_IGNORED_DIRS = {'node_modules', '.git', '__pycache__', PIPELINE_DIR_NAME}
+PROJECT_MANIFEST_CACHE_SIZE = 64
+project_manifests = collections.OrderedDict()
+project_manifests_lock = threading.Lock()
 
-        keywords_text = response.choices[0].message.content.strip()
-        tags = [tag.strip() for tag in keywords_text.split() if 3 <= len(tag.strip()) <= 15]
-        return tags[:5]
-    except Exception as e:
-        logger.warning(f"Tag generation error: {e}")
-        return []
+class ProjectManifest:
+    """Snapshot of the files in a project directory, relative POSIX paths"""
 
-def filter_project_files(files, project_path):
-    """Filter out version folders from file list"""
-    return [f for f in files if f.is_file() and not str(f.relative_to(project_path)).startswith('v')]
+    def __init__(self, root, files):
+        self.root = Path(root)
+        self.files = files
+        self.html_files = [f for f in files if f.lower().endswith('.html')]
+        self.scanned_at = time.time()
+
+    def paths(self):
+        return [self.root / f for f in self.files]
+
+def scan_project_files(project_path, refresh=False):
+    """Walk a project once and cache the result for the rest of the stage
+
+    Skips the top-level v{n} backups and dependency folders such as
+    node_modules. Pass refresh=True at stage boundaries (before the Claude
+    run and after it) to pick up changes. The cache keeps the most recently
+    used PROJECT_MANIFEST_CACHE_SIZE projects.
+    """
+    project_path = Path(project_path)
+    key = str(project_path.resolve())
+    if not refresh:
+        with project_manifests_lock:
+            if key in project_manifests:
+                project_manifests.move_to_end(key)
+                return project_manifests[key]
+    files = []
+    if project_path.exists():
+        for root, dirs, filenames in os.walk(project_path):
+            top_level = Path(root) == project_path
+            dirs[:] = sorted(d for d in dirs if d not in SCAN_IGNORED_DIRS and not (top_level and is_version_dir(d)))
+            rel_root = Path(root).relative_to(project_path)
+            for filename in sorted(filenames):
+                files.append((rel_root / filename).as_posix())
+    manifest = ProjectManifest(project_path, files)
+    with project_manifests_lock:
+        project_manifests[key] = manifest
+        project_manifests.move_to_end(key)
+        while len(project_manifests) > PROJECT_MANIFEST_CACHE_SIZE:
+            project_manifests.popitem(last=False)
+    return manifest
 
 async def update_reaction(message, old_emoji, new_emoji):
     """Update message reaction"""
@@ -131,10 +415,42 @@ COMMAND_BASE_PATH = os.getenv('COMMAND_BASE_PATH', './projects')
 PROJECT_BASE_URL = os.getenv('PROJECT_BASE_URL', '')
 PROMPT_ALIAS_SPREADSHEET_ID = os.getenv('PROMPT_ALIAS_SPREADSHEET_ID', '')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
+CLAUDE_MAX_CONCURRENT_JOBS = max(1, int(os.getenv('CLAUDE_MAX_CONCURRENT_JOBS', '2')))
+CLAUDE_MAX_QUEUED_JOBS = max(0, int(os.getenv('CLAUDE_MAX_QUEUED_JOBS', '10')))
+CLAUDE_JOB_ESTIMATE_SECONDS = int(os.getenv('CLAUDE_JOB_ESTIMATE_SECONDS', '300'))
+CLAUDE_MAX_JOBS_PER_USER = max(1, int(os.getenv('CLAUDE_MAX_JOBS_PER_USER', '1')))
+CLAUDE_MAX_QUEUED_PER_USER = max(1, int(os.getenv('CLAUDE_MAX_QUEUED_PER_USER', '3')))
+CLAUDE_MAX_JOBS_PER_USER_HOUR = max(0, int(os.getenv('CLAUDE_MAX_JOBS_PER_USER_HOUR', '10')))
+CLAUDE_PRIORITY_WEIGHTS = os.getenv('CLAUDE_PRIORITY_WEIGHTS', 'high=4,normal=2,low=1')
+CLAUDE_PRIORITY_CHANNELS = os.getenv('CLAUDE_PRIORITY_CHANNELS', '')
+CLAUDE_PRIORITY_ROLES = os.getenv('CLAUDE_PRIORITY_ROLES', '')
+CLAUDE_STREAM_JSON = os.getenv('CLAUDE_STREAM_JSON', 'true').lower() in ('1', 'true', 'yes')
+CLAUDE_SESSION_RESUME = os.getenv('CLAUDE_SESSION_RESUME', 'true').lower() in ('1', 'true', 'yes')
+CLAUDE_SESSION_MAX_AGE_HOURS = float(os.getenv('CLAUDE_SESSION_MAX_AGE_HOURS', '24'))
+CLAUDE_LOG_DIR = Path(os.getenv('CLAUDE_LOG_DIR', './logs/claude'))
+DISCORD_SEND_RATE = float(os.getenv('DISCORD_SEND_RATE', '1'))
+DISCORD_SEND_BURST = int(os.getenv('DISCORD_SEND_BURST', '5'))
+LOG_ATTACHMENT_THRESHOLD = int(os.getenv('LOG_ATTACHMENT_THRESHOLD', '6000'))
+HTTP_SERVER_HOST = os.getenv('HTTP_SERVER_HOST', '127.0.0.1')
+HTTP_SERVER_PORT = int(os.getenv('HTTP_SERVER_PORT', '0'))
+PROGRESS_EDIT_INTERVAL = float(os.getenv('PROGRESS_EDIT_INTERVAL', '5'))
+STATUS_READY_TIMEOUT = 30
+JOB_JOURNAL_RETENTION_DAYS = float(os.getenv('JOB_JOURNAL_RETENTION_DAYS', '14'))
+STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', '60'))
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+STATIC_COMPRESS_MIN_SIZE = 1024
+STREAM_LINE_LIMIT = 16 * 1024 * 1024
+THUMBNAIL_MAX_PAGES = max(1, int(os.getenv('THUMBNAIL_MAX_PAGES', '2')))
+THUMBNAIL_MODE_TEMPLATE = 'template'
+THUMBNAIL_MODE_CLAUDE = 'claude'
+THUMBNAIL_MODE = os.getenv('THUMBNAIL_MODE', THUMBNAIL_MODE_TEMPLATE)
+THUMBNAIL_CLAUDE_CHANNELS = os.getenv('THUMBNAIL_CLAUDE_CHANNELS', '')
+THUMBNAIL_VARIANT_WIDTHS = (480, 960, 1200)
+THUMBNAIL_AVIF = os.getenv('THUMBNAIL_AVIF', 'false').lower() in ('1', 'true', 'yes')
 
 openai_client = None
 if OPENAI_API_KEY:
-    openai_client = OpenAI(
+    openai_client = AsyncOpenAI(
         api_key=OPENAI_API_KEY,
         timeout=60.0,
         max_retries=2
@@ -148,19 +464,41 @@ Path(COMMAND_BASE_PATH).mkdir(parents=True, exist_ok=True)
 
 prompt_aliases = {}
 prompt_alias_channels = {}
+prompt_alias_thumbnail_modes = {}
+prompt_alias_priorities = {}
 prompt_aliases_last_reload = 0
 prompt_aliases_spreadsheet_url = ''
+prompt_aliases_etag = ''
+prompt_aliases_last_modified = ''
+prompt_aliases_refresh_task = None
+prompt_alias_pattern = None
+prompt_alias_channel_tags = {}
 ALIAS_CACHE_DURATION = 60
-
-def load_prompt_aliases_from_spreadsheet(spreadsheet_url_or_id, silent=False, force=False):
+ai_metadata_cache = {}
+AI_CACHE_PATH = Path(COMMAND_BASE_PATH) / ".ai_cache"
+http_session = None
+
+async def get_http_session():
+    """Shared aiohttp session so alias fetches reuse pooled connections"""
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+    return http_session
+
+async def load_prompt_aliases_from_spreadsheet(spreadsheet_url_or_id, silent=False, force=False):
     """Load prompt aliases from Google Spreadsheet (public URL only)
 
+    Re-fetches of the current spreadsheet send If-None-Match /
+    If-Modified-Since, and a 304 response keeps the loaded aliases.
+
     Args:
         spreadsheet_url_or_id: URL or ID of the Google Spreadsheet
         silent: If True, suppress detailed logging and print output
         force: If True, ignore cache and force reload
     """
-    global prompt_aliases, prompt_alias_channels, prompt_aliases_last_reload, prompt_aliases_spreadsheet_url
+    global prompt_aliases, prompt_alias_channels, prompt_alias_thumbnail_modes, prompt_aliases_last_reload, prompt_aliases_spreadsheet_url
+    global prompt_alias_priorities
+    global prompt_aliases_etag, prompt_aliases_last_modified
     if not force:
         current_time = time.time()
         time_since_reload = current_time - prompt_aliases_last_reload
@@ -182,39 +520,120 @@ def load_prompt_aliases_from_spreadsheet(spreadsheet_url_or_id, silent=False, fo
         full_spreadsheet_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/edit"
 
         csv_url = f"https://docs.google.com/spreadsheets/d/{spreadsheet_id}/export?format=csv&gid=0"
-        response = requests.get(csv_url, timeout=10)
-        response.raise_for_status()
-        csv_content = response.content.decode('utf-8')
+        headers = {}
+        if full_spreadsheet_url == prompt_aliases_spreadsheet_url and prompt_aliases:
+            if prompt_aliases_etag:
+                headers['If-None-Match'] = prompt_aliases_etag
+            if prompt_aliases_last_modified:
+                headers['If-Modified-Since'] = prompt_aliases_last_modified
+        session = await get_http_session()
+        async with session.get(csv_url, headers=headers) as response:
+            if response.status == 304:
+                prompt_aliases_last_reload = time.time()
+                logger.debug("Prompt aliases not modified (304)")
+                return True, f"{len(prompt_aliases)}個のプロンプトエイリアス (変更なし)"
+            if response.status in (403, 404):
+                return False, "スプレッドシートにアクセスできません。「リンクを知っている全員」に共有設定してください"
+            if response.status >= 400:
+                return False, f"スプレッドシート読み込みエラー: HTTPステータス {response.status}"
+            csv_content = (await response.read()).decode('utf-8')
+            etag = response.headers.get('ETag', '')
+            last_modified = response.headers.get('Last-Modified', '')
         csv_reader = csv.DictReader(io.StringIO(csv_content))
         new_aliases = {}
         new_channels = {}
+        new_thumbnail_modes = {}
+        new_priorities = {}
         for row in csv_reader:
             tag = str(row.get('タグ名', row.get('tag', ''))).strip()
             prompt = str(row.get('プロンプト', row.get('prompt', ''))).strip()
             channel = str(row.get('対象チャンネル', row.get('channel', ''))).strip()
+            thumbnail_mode = str(row.get('サムネイル', row.get('thumbnail', '')) or '').strip().lower()
+            priority = str(row.get('優先度', row.get('priority', '')) or '').strip().lower()
             if tag and prompt:
                 new_aliases[tag] = prompt
                 if channel:
                     new_channels[tag] = channel
+                if thumbnail_mode in (THUMBNAIL_MODE_TEMPLATE, THUMBNAIL_MODE_CLAUDE):
+                    new_thumbnail_modes[tag] = thumbnail_mode
+                if priority in priority_weights:
+                    new_priorities[tag] = priority
         if not new_aliases:
             return False, "スプレッドシートが空か、正しい列名がありません（タグ名/tag, プロンプト/prompt）"
         prompt_aliases = new_aliases
         prompt_alias_channels = new_channels
+        prompt_alias_thumbnail_modes = new_thumbnail_modes
+        prompt_alias_priorities = new_priorities
+        build_prompt_alias_index(new_aliases, new_channels)
         prompt_aliases_spreadsheet_url = full_spreadsheet_url
+        prompt_aliases_etag = etag
+        prompt_aliases_last_modified = last_modified
         prompt_aliases_last_reload = time.time()
         if not silent:
             tags_summary = [f"#{tag}" + (f"[{new_channels[tag]}]" if tag in new_channels else "") for tag in sorted(new_aliases.keys())]
             log_info(f"✅ Loaded {len(new_aliases)} prompt aliases: {', '.join(tags_summary)}")
         tag_list = ", ".join([f"#{tag}" for tag in sorted(new_aliases.keys())])
         return True, f"{len(new_aliases)}個のプロンプトエイリアスを読み込みました\n📋 タグ一覧: {tag_list}"
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 403 or e.response.status_code == 404:
-            return False, "スプレッドシートにアクセスできません。「リンクを知っている全員」に共有設定してください"
-        else:
-            return False, f"スプレッドシート読み込みエラー: HTTPステータス {e.response.status_code}"
+    except asyncio.TimeoutError:
+        return False, "スプレッドシート読み込みエラー: タイムアウトしました"
     except Exception as e:
         return False, f"スプレッドシート読み込みエラー: {str(e)}"
 
+def refresh_prompt_aliases_in_background():
+    """Stale-while-revalidate: start a reload if the cache expired, without waiting for it"""
+    global prompt_aliases_refresh_task
+    source = prompt_aliases_spreadsheet_url or PROMPT_ALIAS_SPREADSHEET_ID
+    if not source or time.time() - prompt_aliases_last_reload < ALIAS_CACHE_DURATION:
+        return
+    if prompt_aliases_refresh_task and not prompt_aliases_refresh_task.done():
+        return
+    prompt_aliases_refresh_task = asyncio.create_task(load_prompt_aliases_from_spreadsheet(source, silent=True, force=True))
+
+async def prompt_alias_refresh_loop():
+    """Periodically revalidate the alias spreadsheet"""
+    while True:
+        await asyncio.sleep(ALIAS_CACHE_DURATION)
+        source = prompt_aliases_spreadsheet_url or PROMPT_ALIAS_SPREADSHEET_ID
+        if not source:
+            continue
+        try:
+            success, message = await load_prompt_aliases_from_spreadsheet(source, silent=True, force=True)
+            if not success:
+                logger.warning(f"⚠️ Failed to refresh aliases: {message}")
+        except Exception as e:
+            logger.warning(f"Alias refresh error: {e}")
+
+def build_prompt_alias_index(aliases, channels):
+    """Precompile the alias matcher and the channel -> auto-append tag map
+
+    Tags are matched as whole tokens, so #react does not match inside
+    #reactnative. Longer tags are tried first. The boundary is ASCII-only
+    so Japanese text may follow a tag directly (#reactのTODO). Japanese has
+    no word separators, so for CJK text the longest alias prefix wins and
+    the rest is free text: #ゲームズ applies #ゲーム followed by ズ.
+    """
+    global prompt_alias_pattern, prompt_alias_channel_tags
+    if aliases:
+        alternatives = '|'.join(re.escape(tag) for tag in sorted(aliases, key=len, reverse=True))
+        prompt_alias_pattern = re.compile(f'#({alternatives})(?![A-Za-z0-9_])')
+    else:
+        prompt_alias_pattern = None
+    channel_tags = {}
+    for tag, allowed_channels_str in channels.items():
+        for allowed in allowed_channels_str.split(','):
+            allowed = allowed.strip()
+            if allowed:
+                channel_tags.setdefault(allowed, []).append(tag)
+    prompt_alias_channel_tags = channel_tags
+
+def unknown_prompt_tags_in(prompt):
+    """#tags in the prompt that no alias matches, using the same rule as the alias matcher"""
+    unknown = []
+    for match in re.finditer(r'#(\w+)', prompt):
+        if not (prompt_alias_pattern and prompt_alias_pattern.match(prompt, match.start())):
+            unknown.append(match.group(1))
+    return unknown
+
 def replace_prompt_aliases(prompt, channel_id=None, channel_name=None):
     """Replace prompt aliases in text and auto-append channel-specific prompts
 
@@ -222,37 +641,29 @@ def replace_prompt_aliases(prompt, channel_id=None, channel_name=None):
         tuple: (final_prompt, user_instruction, alias_guidelines, replaced_tags, auto_appended)
     """
     logger.info(f"ALIAS_REPLACE | Channel: {channel_name} ({channel_id}) | Prompt: {prompt[:100]} | Available: {len(prompt_aliases)} aliases")
-    user_instruction = prompt
     alias_contents = []
     replaced_tags = []
     auto_appended = []
-    for tag, replacement in prompt_aliases.items():
-        tag_pattern = f"#{tag}"
-        if tag in prompt_alias_channels:
-            allowed_channels_str = prompt_alias_channels[tag]
-            allowed_channels = [ch.strip() for ch in allowed_channels_str.split(',')]
-            is_target_channel = False
-            if channel_id or channel_name:
-                channel_id_str = str(channel_id) if channel_id else None
-                for allowed in allowed_channels:
-                    if (channel_name and allowed == channel_name) or (channel_id_str and allowed == channel_id_str):
-                        is_target_channel = True
-                        break
-            if tag_pattern in user_instruction:
-                logger.debug(f"Collecting #{tag} (channel-restricted, explicit)")
-                alias_contents.append(f"[#{tag}]\n{replacement}")
-                user_instruction = user_instruction.replace(tag_pattern, "").strip()
-                replaced_tags.append(tag)
-            elif is_target_channel:
-                logger.debug(f"Auto-appending #{tag} (channel-matched)")
-                alias_contents.append(f"[#{tag} - 自動適用]\n{replacement}")
-                auto_appended.append(tag)
-        else:
-            if tag_pattern in user_instruction:
-                logger.debug(f"Collecting #{tag} (unrestricted)")
-                alias_contents.append(f"[#{tag}]\n{replacement}")
-                user_instruction = user_instruction.replace(tag_pattern, "").strip()
-                replaced_tags.append(tag)
+
+    def collect(match):
+        tag = match.group(1)
+        if tag not in replaced_tags:
+            restriction = 'channel-restricted, explicit' if tag in prompt_alias_channels else 'unrestricted'
+            logger.debug(f"Collecting #{tag} ({restriction})")
+            alias_contents.append(f"[#{tag}]\n{prompt_aliases[tag]}")
+            replaced_tags.append(tag)
+        return ''
+
+    user_instruction = prompt_alias_pattern.sub(collect, prompt) if prompt_alias_pattern else prompt
+    channel_matched = []
+    for key in (channel_name, str(channel_id) if channel_id else None):
+        if key:
+            channel_matched.extend(prompt_alias_channel_tags.get(key, []))
+    for tag in dict.fromkeys(channel_matched):
+        if tag not in replaced_tags and tag in prompt_aliases:
+            logger.debug(f"Auto-appending #{tag} (channel-matched)")
+            alias_contents.append(f"[#{tag} - 自動適用]\n{prompt_aliases[tag]}")
+            auto_appended.append(tag)
     user_instruction = ' '.join(user_instruction.split())
     alias_guidelines = "\n\n".join(alias_contents) if alias_contents else ""
     if alias_guidelines:
@@ -272,27 +683,152 @@ def replace_prompt_aliases(prompt, channel_id=None, channel_name=None):
     logger.info(f"ALIAS_RESULT | Replaced: {replaced_tags} | Auto: {auto_appended} | Final length: {len(final_prompt)} chars")
     return final_prompt, user_instruction, alias_guidelines, replaced_tags, auto_appended
 
+VERSION_DIR_PATTERN = re.compile(r'v\d+')
+VERSION_STORE_PATH = Path(COMMAND_BASE_PATH) / ".versions"
+BLOB_STORE_PATH = Path(COMMAND_BASE_PATH) / ".blobs"
+BLOB_MODE_MASK = 0o7555
+
+def is_version_dir(name):
+    """True for backup folders created by backup_project_version (v0, v1, ...)"""
+    return VERSION_DIR_PATTERN.fullmatch(name) is not None
+
+def hash_file(path):
+    """SHA-256 of a file, read in chunks"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_json_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+    os.replace(tmp_path, path)
+
+def load_version_index(project_id):
+    """Hash cache {path: [size, mtime_ns, digest]} of the project's last backup
+
+    Each version's own file map lives in .versions/<project>/v{n}.json, so
+    a backup only reads and rewrites this index plus one new file.
+    Manifests from before that split are migrated on first read.
+    """
+    index_path = VERSION_STORE_PATH / f"{project_id}.json"
+    if not index_path.exists():
+        return {}
+    try:
+        manifest = json.loads(index_path.read_text(encoding='utf-8'))
+    except Exception as e:
+        logger.warning(f"Version index read error ({project_id}): {e}")
+        return {}
+    if 'versions' in manifest:
+        for entry in manifest.pop('versions'):
+            write_json_atomic(VERSION_STORE_PATH / project_id / f"v{entry['version']}.json", entry)
+        write_json_atomic(index_path, manifest)
+    return manifest.get('index', {})
+
+def recorded_versions(project_id):
+    """Version numbers that have a file map under .versions/<project>/"""
+    versions_dir = VERSION_STORE_PATH / project_id
+    if not versions_dir.is_dir():
+        return []
+    return [int(path.stem[1:]) for path in versions_dir.glob('v*.json') if is_version_dir(path.stem)]
+
+PROJECT_META_PATH = Path(COMMAND_BASE_PATH) / ".project_meta"
+
+def load_project_metadata(project_id):
+    """Per-project bot state (thumbnail fingerprint, ...) kept outside the project tree"""
+    metadata_path = PROJECT_META_PATH / f"{project_id}.json"
+    if metadata_path.exists():
+        try:
+            return json.loads(metadata_path.read_text(encoding='utf-8'))
+        except Exception as e:
+            logger.warning(f"Project metadata read error ({project_id}): {e}")
+    return {}
+
+def update_project_metadata(project_id, **fields):
+    metadata = load_project_metadata(project_id)
+    metadata.update(fields)
+    write_json_atomic(PROJECT_META_PATH / f"{project_id}.json", metadata)
+    return metadata
+
+def store_blob(source_path, digest):
+    """Copy a file into the content-addressed blob store once; return the blob path
+
+    Blobs are read-only: v{n} files are hardlinks to them, so an in-place
+    write to one backup file would otherwise change every version sharing it.
+    """
+    blob_path = BLOB_STORE_PATH / digest[:2] / digest
+    if not blob_path.exists():
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = blob_path.with_name(f"{digest}.{uuid.uuid4().hex}.tmp")
+        shutil.copy2(source_path, tmp_path)
+        os.chmod(tmp_path, os.stat(tmp_path).st_mode & BLOB_MODE_MASK)
+        os.replace(tmp_path, blob_path)
+    else:
+        mode = blob_path.stat().st_mode
+        if mode & 0o222:
+            os.chmod(blob_path, mode & BLOB_MODE_MASK)
+    return blob_path
+
 def backup_project_version(project_path):
-    """Backup existing project to versioned subfolder"""
+    """Backup existing project to versioned subfolder
+
+    Files are deduplicated through a content-addressed blob store and
+    hardlinked into v{n}, so identical files across versions share disk
+    space. The per-project index caches file hashes by size and mtime,
+    so only changed files are re-hashed. Blocking; run it in a thread.
+    """
     try:
         project_path = Path(project_path)
         if not project_path.exists():
             return None
-        version = 0
-        while True:
-            backup_path = project_path / f"v{version}"
-            if not backup_path.exists():
-                break
-            version += 1
+        project_id = project_path.name
+        old_index = load_version_index(project_id)
+        existing_versions = [int(item.name[1:]) for item in project_path.iterdir() if item.is_dir() and is_version_dir(item.name)]
+        version = max(existing_versions + recorded_versions(project_id), default=-1) + 1
+        backup_path = project_path / f"v{version}"
         backup_path.mkdir(parents=True, exist_ok=True)
-        for item in project_path.iterdir():
-            if item.is_file():
-                shutil.copy2(item, backup_path / item.name)
-            elif item.is_dir() and not item.name.startswith('v'):
-                shutil.copytree(item, backup_path / item.name, dirs_exist_ok=True)
+        new_index = {}
+        files = {}
+        hashed = 0
+        linked = 0
+        for root, dirs, filenames in os.walk(project_path):
+            root_path = Path(root)
+            if root_path == project_path:
+                dirs[:] = [d for d in dirs if not is_version_dir(d) and d != PIPELINE_DIR_NAME]
+            for filename in filenames:
+                source = root_path / filename
+                if source.is_symlink():
+                    continue
+                rel_path = source.relative_to(project_path).as_posix()
+                stat = source.stat()
+                cached = old_index.get(rel_path)
+                if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+                    digest = cached[2]
+                else:
+                    digest = hash_file(source)
+                    hashed += 1
+                new_index[rel_path] = [stat.st_size, stat.st_mtime_ns, digest]
+                files[rel_path] = digest
+                blob_path = store_blob(source, digest)
+                target = backup_path / rel_path
+                target.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    os.link(blob_path, target)
+                    linked += 1
+                except OSError:
+                    shutil.copy2(blob_path, target)
+        write_json_atomic(VERSION_STORE_PATH / project_id / f"v{version}.json", {
+            'version': version,
+            'created_at': datetime.now().isoformat(),
+            'files': files
+        })
+        write_json_atomic(VERSION_STORE_PATH / f"{project_id}.json", {'index': new_index})
+        logger.info(f"Backup v{version} for {project_id}: {len(files)} files, {hashed} hashed, {linked} hardlinked")
         return backup_path
     except Exception as e:
-        print(f"Backup error: {e}")
+        logger.error(f"Backup error: {e}", exc_info=True)
         return None
 
 async def list_project_files(project_path):
@@ -301,11 +837,7 @@ async def list_project_files(project_path):
         project_path = Path(project_path)
         if not project_path.exists():
             return "プロジェクトディレクトリが存在しません"
-        files = []
-        for item in sorted(project_path.rglob('*')):
-            if item.is_file():
-                rel_path = item.relative_to(project_path)
-                files.append(f"  {rel_path}")
+        files = [f"  {rel_path}" for rel_path in scan_project_files(project_path).files]
         if files:
             return "📄 **プロジェクトファイル:**\n" + "\n".join(files)
         else:
@@ -313,20 +845,33 @@ async def list_project_files(project_path):
     except Exception as e:
         return f"ファイル一覧取得エラー: {str(e)}"
 
-async def update_html_meta_tags(project_path, summary, project_url, thumbnail_url):
-    """Update HTML files with proper OGP meta tags"""
-    try:
-        project_path = Path(project_path)
-        html_files = list(project_path.rglob('*.html'))
-        for html_file in html_files:
-            try:
-                with open(html_file, 'r', encoding='utf-8') as f:
-                    content = f.read()
-                seo_description = summary[:120] if len(summary) <= 120 else summary[:117] + "..."
-                new_meta_tags = f'''
-    <!-- Open Graph / OGP - Auto-generated by Bot -->
-    <meta property="og:title" content="{summary}">
-    <meta property="og:description" content="{seo_description}">
+OGP_BLOCK_PATTERNS = [
+    re.compile(r'<!--\s*Open Graph(?:(?!-->).)*-->\s*(<meta\s+property="og:[^>]*>\s*)+', re.DOTALL | re.IGNORECASE),
+    re.compile(r'<meta\s+property="og:[^>]*>\s*', re.IGNORECASE),
+    re.compile(r'<!--\s*Twitter Card(?:(?!-->).)*-->\s*(<meta\s+name="twitter:[^>]*>\s*)+', re.DOTALL | re.IGNORECASE),
+    re.compile(r'<meta\s+name="twitter:[^>]*>\s*', re.IGNORECASE),
+]
+HEAD_CLOSE_PATTERN = re.compile(r'</head\s*>', re.IGNORECASE)
+OGP_ENTRY_DIRS = {'', 'htdocs', 'public'}
+
+def ogp_entry_html_files(project_path):
+    """HTML entry points that get OGP tags: top level, htdocs/ and public/"""
+    entries = []
+    for rel_path in scan_project_files(project_path).html_files:
+        parent = rel_path.rpartition('/')[0]
+        if parent in OGP_ENTRY_DIRS and rel_path.rpartition('/')[2] != 'thumbnail.html':
+            entries.append(Path(project_path) / rel_path)
+    return entries
+
+def build_ogp_meta_block(summary, project_url, thumbnail_url):
+    seo_description = summary[:120] if len(summary) <= 120 else summary[:117] + "..."
+    title = html.escape(summary, quote=True)
+    description = html.escape(seo_description, quote=True)
+    project_url = html.escape(project_url, quote=True)
+    thumbnail_url = html.escape(thumbnail_url, quote=True)
+    return f'''    <!-- Open Graph / OGP - Auto-generated by Bot -->
+    <meta property="og:title" content="{title}">
+    <meta property="og:description" content="{description}">
     <meta property="og:type" content="website">
     <meta property="og:url" content="{project_url}">
     <meta property="og:image" content="{thumbnail_url}">
@@ -335,106 +880,239 @@ async def update_html_meta_tags(project_path, summary, project_url, thumbnail_ur
 
     <!-- Twitter Card - Auto-generated by Bot -->
     <meta name="twitter:card" content="summary_large_image">
-    <meta name="twitter:title" content="{summary}">
-    <meta name="twitter:description" content="{seo_description}">
+    <meta name="twitter:title" content="{title}">
+    <meta name="twitter:description" content="{description}">
     <meta name="twitter:image" content="{thumbnail_url}">
 '''
-                if 'og:image' in content or 'twitter:image' in content:
-                    print(f"🔄 {html_file.name}: 既存のOGPタグを更新します")
-                    content = re.sub(
-                        r'<!--\s*Open Graph.*?-->\s*(<meta\s+property="og:.*?>\s*)+',
-                        '',
-                        content,
-                        flags=re.DOTALL | re.IGNORECASE
-                    )
-                    content = re.sub(
-                        r'<meta\s+property="og:.*?>\s*',
-                        '',
-                        content,
-                        flags=re.IGNORECASE
-                    )
-                    content = re.sub(
-                        r'<!--\s*Twitter Card.*?-->\s*(<meta\s+name="twitter:.*?>\s*)+',
-                        '',
-                        content,
-                        flags=re.DOTALL | re.IGNORECASE
-                    )
-                    content = re.sub(
-                        r'<meta\s+name="twitter:.*?>\s*',
-                        '',
-                        content,
-                        flags=re.IGNORECASE
-                    )
-                    print(f"✅ {html_file.name}: 既存のメタタグを削除しました")
-                if '</head>' in content:
-                    updated_content = content.replace('</head>', new_meta_tags + '  </head>')
-                    with open(html_file, 'w', encoding='utf-8') as f:
-                        f.write(updated_content)
-                    print(f"✅ {html_file.name}: 生成されたサムネイルURLでOGPメタタグを更新しました")
-                    print(f"   📸 画像URL: {thumbnail_url}")
+
+def rewrite_ogp_meta_tags(html_file, meta_block):
+    """Replace the OGP/Twitter tags inside <head> of one file
+
+    Only the <head> region is searched. The file is left untouched when
+    it already carries exactly this block, and is otherwise written via a
+    temp file and atomic rename.
+
+    Returns:
+        str: 'updated', 'unchanged' or 'no_head'
+    """
+    html_file = Path(html_file)
+    content = html_file.read_text(encoding='utf-8')
+    head_close = HEAD_CLOSE_PATTERN.search(content)
+    if not head_close:
+        return 'no_head'
+    head = content[:head_close.start()]
+    for pattern in OGP_BLOCK_PATTERNS:
+        head = pattern.sub('', head)
+    updated_content = head.rstrip() + '\n\n' + meta_block + '  ' + content[head_close.start():]
+    if updated_content == content:
+        return 'unchanged'
+    tmp_path = html_file.with_name(f".{html_file.name}.{uuid.uuid4().hex}.tmp")
+    tmp_path.write_text(updated_content, encoding='utf-8')
+    os.replace(tmp_path, html_file)
+    return 'updated'
+
+async def update_html_meta_tags(project_path, summary, project_url, thumbnail_url):
+    """Update entry-point HTML files with proper OGP meta tags"""
+    try:
+        project_path = Path(project_path)
+        meta_block = build_ogp_meta_block(summary, project_url, thumbnail_url)
+        for html_file in ogp_entry_html_files(project_path):
+            try:
+                result = await asyncio.to_thread(rewrite_ogp_meta_tags, html_file, meta_block)
+                if result == 'updated':
+                    logger.info(f"✅ {html_file.name}: 生成されたサムネイルURLでOGPメタタグを更新しました (画像URL: {thumbnail_url})")
+                elif result == 'unchanged':
+                    logger.info(f"⏭️ {html_file.name}: OGPメタタグは最新です")
                 else:
-                    print(f"⚠️ {html_file.name}: </head>タグが見つかりません")
+                    logger.warning(f"⚠️ {html_file.name}: </head>タグが見つかりません")
             except Exception as e:
-                print(f"❌ {html_file.name}: メタタグ更新エラー: {e}")
-                import traceback
-                traceback.print_exc()
+                logger.error(f"❌ {html_file.name}: メタタグ更新エラー: {e}", exc_info=True)
         return True
     except Exception as e:
-        print(f"❌ HTMLメタタグ更新エラー: {e}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"❌ HTMLメタタグ更新エラー: {e}", exc_info=True)
         return False
 
-async def generate_project_summary_with_ai(project_path, prompt, stdout):
-    """Generate a one-line summary using ChatGPT API"""
+AI_METADATA_SYSTEM_PROMPT = """あなたはプロジェクト要約とタグ生成の専門家です。
+ユーザーの指示と生成されたファイルリストから、以下の2つを作成してJSONで出力してください。
+
+1. summary: プロジェクトの内容を日本語で1文（30文字以内）で要約
+   - ユーザー目線で、プロジェクトの本質だけを簡潔に表現
+   - 「Webページ」「プロジェクト」などの自明な情報は省略
+   - 例: 「じゃんけんゲーム」「ToDoリスト管理アプリ」「天気予報API（Python）」「レスポンシブなポートフォリオ」「リアルタイムチャット」
+2. tags: 検索やフィルタリングに適したキーワードの配列
+   - 3〜5個、各キーワードは3〜15文字程度
+   - 技術名、ジャンル、特徴を表すキーワード
+   - 例: ["ゲーム", "じゃんけん", "JavaScript", "インタラクティブ"]
+
+出力形式:
+{"summary": "...", "tags": ["...", "..."]}"""
+
+def load_ai_metadata_cache(cache_key):
+    """Return cached (summary, tags) for a cache key, or None"""
+    if cache_key in ai_metadata_cache:
+        return ai_metadata_cache[cache_key]
+    cache_file = AI_CACHE_PATH / f"{cache_key}.json"
+    if not cache_file.exists():
+        return None
+    try:
+        data = json.loads(cache_file.read_text(encoding='utf-8'))
+        result = (data['summary'], data['tags'])
+    except Exception as e:
+        logger.warning(f"AI cache read error ({cache_key}): {e}")
+        return None
+    ai_metadata_cache[cache_key] = result
+    return result
+
+def save_ai_metadata_cache(cache_key, summary, tags):
+    """Store (summary, tags) in memory and on disk under its content hash"""
+    ai_metadata_cache[cache_key] = (summary, tags)
+    try:
+        AI_CACHE_PATH.mkdir(parents=True, exist_ok=True)
+        cache_file = AI_CACHE_PATH / f"{cache_key}.json"
+        cache_file.write_text(json.dumps({'summary': summary, 'tags': tags}, ensure_ascii=False), encoding='utf-8')
+    except Exception as e:
+        logger.warning(f"AI cache write error ({cache_key}): {e}")
+
+async def generate_project_metadata_with_ai(project_path, prompt):
+    """Generate the one-line summary and search tags in a single ChatGPT call
+
+    Results are cached by a hash of the prompt and the project file list, so
+    re-running an unchanged project makes no API call.
+
+    Returns:
+        tuple: (summary, tags)
+    """
     if not openai_client:
         raise Exception("OpenAI client not configured")
     project_path = Path(project_path)
     if not project_path.exists():
         raise Exception("Project path does not exist")
-    files = list(project_path.rglob('*'))
-    files = filter_project_files(files, project_path)
-    if not files:
+    relative_paths = scan_project_files(project_path).files
+    if not relative_paths:
         raise Exception("No files in project")
-    file_list = "\n".join([f"- {f.relative_to(project_path)}" for f in files[:20]])
-    if len(files) > 20:
-        file_list += f"\n... 他{len(files) - 20}個のファイル"
-    system_prompt = """あなたはプロジェクト要約の専門家です。
-ユーザーの指示と生成されたファイルリストから、プロジェクトの内容を日本語で1文（30文字以内）で要約してください。
-ユーザー目線で、プロジェクトの本質だけを簡潔に表現してください。
-「Webページ」「プロジェクト」などの自明な情報は省略してください。
-例:
-- 「じゃんけんゲーム」
-- 「ToDoリスト管理アプリ」
-- 「天気予報API（Python）」
-- 「レスポンシブなポートフォリオ」
-- 「リアルタイムチャット」"""
+    file_list_hash = hashlib.sha256("\n".join(relative_paths).encode('utf-8')).hexdigest()
+    cache_key = hashlib.sha256(f"{prompt}\0{file_list_hash}".encode('utf-8')).hexdigest()
+    cached = load_ai_metadata_cache(cache_key)
+    if cached:
+        logger.info(f"AI metadata cache hit: {cache_key[:12]}")
+        return cached
+    file_list = "\n".join([f"- {path}" for path in relative_paths[:20]])
+    if len(relative_paths) > 20:
+        file_list += f"\n... 他{len(relative_paths) - 20}個のファイル"
     user_prompt = f"""ユーザーの指示: {prompt}
 
 生成されたファイル:
 {file_list}
 
-この内容を1文で要約してください。"""
-    response = await asyncio.wait_for(
-        asyncio.to_thread(
-            openai_client.chat.completions.create,
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            max_tokens=100,
-            temperature=0.7
-        ),
-        timeout=30
-    )
-    return response.choices[0].message.content.strip()
+この内容の要約とタグをJSONで出力してください。"""
+    try:
+        with OPENAI_DURATION.time(operation='project_metadata'):
+            response = await asyncio.wait_for(
+                openai_client.chat.completions.create(
+                    model="gpt-4o-mini",
+                    messages=[
+                        {"role": "system", "content": AI_METADATA_SYSTEM_PROMPT},
+                        {"role": "user", "content": user_prompt}
+                    ],
+                    response_format={"type": "json_object"},
+                    max_tokens=200,
+                    temperature=0.5
+                ),
+                timeout=30
+            )
+    except Exception:
+        OPENAI_ERRORS.inc(operation='project_metadata')
+        raise
+    data = json.loads(response.choices[0].message.content)
+    summary = str(data.get('summary', '')).strip()
+    if not summary:
+        raise Exception("AI response did not include a summary")
+    raw_tags = data.get('tags', [])
+    if isinstance(raw_tags, str):
+        raw_tags = raw_tags.split()
+    tags = [str(tag).strip() for tag in raw_tags if 3 <= len(str(tag).strip()) <= 15][:5]
+    save_ai_metadata_cache(cache_key, summary, tags)
+    return summary, tags
+
+class ThumbnailBrowserPool:
+    """Long-lived headless Chromium shared by all thumbnail screenshots
+
+    The browser is launched once and relaunched only when it has crashed or
+    disconnected. Every screenshot gets its own browser context so pages
+    never share cookies, storage or cache.
+    """
+
+    LAUNCH_ARGS = [
+        '--no-sandbox',
+        '--disable-dev-shm-usage',
+        '--disable-gpu',
+        '--disable-software-rasterizer',
+        '--disable-extensions',
+        '--disable-background-networking',
+        '--disable-sync',
+    ]
+
+    def __init__(self, max_pages):
+        self.max_pages = max_pages
+        self.playwright = None
+        self.browser = None
+        self._lock = asyncio.Lock()
+        self._semaphore = asyncio.Semaphore(max_pages)
+
+    async def start(self):
+        """Launch the browser up front so the first request doesn't pay for it"""
+        try:
+            await self.get_browser()
+            log_info(f"🌐 サムネイル用ブラウザを起動しました (同時ページ数: {self.max_pages})")
+        except ImportError:
+            logger.error("Playwright is not installed. Run: playwright install chromium")
+        except Exception as e:
+            logger.error(f"Thumbnail browser start error: {e}", exc_info=True)
+
+    async def get_browser(self):
+        """Return a connected browser, relaunching it if the health check fails"""
+        async with self._lock:
+            if self.browser and self.browser.is_connected():
+                return self.browser
+            if self.browser:
+                logger.warning("Thumbnail browser disconnected, relaunching")
+                try:
+                    await self.browser.close()
+                except Exception as close_error:
+                    logger.warning(f"Browser close error: {close_error}")
+                self.browser = None
+            if not self.playwright:
+                from playwright.async_api import async_playwright
+                self.playwright = await async_playwright().start()
+            self.browser = await self.playwright.chromium.launch(args=self.LAUNCH_ARGS)
+            logger.info("Thumbnail browser launched")
+            return self.browser
+
+    async def screenshot(self, html_path, png_path, width=1200, height=630):
+        """Render a local HTML file to PNG in an isolated browser context"""
+        async with self._semaphore:
+            browser = await self.get_browser()
+            context = await browser.new_context(viewport={'width': width, 'height': height})
+            try:
+                page = await context.new_page()
+                await page.goto(
+                    f'file:///{Path(html_path).resolve()}',
+                    timeout=10000,
+                    wait_until='load'
+                )
+                await page.evaluate("document.fonts.ready.then(() => true)")
+                await page.screenshot(path=str(png_path), type='png')
+            finally:
+                try:
+                    await context.close()
+                except Exception as close_error:
+                    logger.warning(f"Browser context close error: {close_error}")
+
+thumbnail_browser_pool = ThumbnailBrowserPool(THUMBNAIL_MAX_PAGES)
 
 async def generate_claude_code_thumbnail(project_path, project_summary, prompt):
     """Generate thumbnail using Claude Code to create HTML, then screenshot with Playwright"""
-    browser = None
     try:
-        from playwright.async_api import async_playwright
         project_path = Path(project_path)
         thumbnail_html_path = project_path / "thumbnail.html"
         thumbnail_png_path = project_path / "thumbnail.png"
@@ -515,79 +1193,577 @@ Example structure:
             logger.warning(f"Claude Code did not create thumbnail.html (rc={returncode})")
             return None
         logger.info(f"thumbnail.html created (rc={returncode}), starting Playwright screenshot")
-        async with async_playwright() as p:
-            try:
-                browser = await p.chromium.launch(
-                    args=[
-                        '--no-sandbox',
-                        '--disable-dev-shm-usage',
-                        '--disable-gpu',
-                        '--disable-software-rasterizer',
-                        '--disable-extensions',
-                        '--disable-background-networking',
-                        '--disable-sync',
-                    ]
-                )
-                page = await browser.new_page(viewport={'width': 1200, 'height': 630})
-                await page.goto(
-                    f'file:///{thumbnail_html_path.resolve()}',
-                    timeout=10000,
-                    wait_until='networkidle'
-                )
-                await page.wait_for_timeout(1000)
-                await page.screenshot(path=str(thumbnail_png_path), type='png')
-            finally:
-                if browser:
-                    try:
-                        await browser.close()
-                    except Exception as close_error:
-                        logger.warning(f"Browser close error: {close_error}")
+        await thumbnail_browser_pool.screenshot(thumbnail_html_path, thumbnail_png_path)
         if thumbnail_png_path.exists() and thumbnail_png_path.stat().st_size > 0:
             logger.info(f"Thumbnail generation success: {thumbnail_png_path.name} ({thumbnail_png_path.stat().st_size} bytes)")
             return thumbnail_png_path
         else:
             logger.warning(f"Screenshot file missing or empty")
             return None
+    except ImportError:
+        logger.error("❌ Playwrightがインストールされていません。インストール方法: pip install playwright && playwright install chromium")
+        return None
+    except Exception as e:
+        logger.error(f"❌ Claude Code サムネイル生成エラー: {type(e).__name__}: {str(e)}", exc_info=True)
+        return None
+
+THUMBNAIL_PALETTES = [
+    ('#667eea', '#764ba2', '#ffffff'),
+    ('#11998e', '#38ef7d', '#ffffff'),
+    ('#ff6a88', '#ff99ac', '#ffffff'),
+    ('#2b5876', '#4e4376', '#ffffff'),
+    ('#f7971e', '#ffd200', '#3a2400'),
+    ('#1e3c72', '#2a5298', '#ffffff'),
+    ('#e0eafc', '#cfdef3', '#1f2d3d'),
+    ('#0f2027', '#2c5364', '#ffffff'),
+]
+
+THUMBNAIL_TEMPLATE = """<!DOCTYPE html>
+<html lang="ja">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=1200, height=630">
+    <title>{{ title }}</title>
+    <style>
+        body {
+            margin: 0;
+            width: 1200px;
+            height: 630px;
+            display: flex;
+            align-items: center;
+            justify-content: center;
+            background: linear-gradient(135deg, {{ start }} 0%, {{ end }} 100%);
+            font-family: 'Noto Sans JP', 'Hiragino Sans', 'Yu Gothic', 'Segoe UI', sans-serif;
+            color: {{ text }};
+            overflow: hidden;
+        }
+        .container { width: 1000px; text-align: center; }
+        h1 {
+            font-size: {{ font_size }}px;
+            line-height: 1.3;
+            margin: 0;
+            font-weight: 800;
+            letter-spacing: 0.02em;
+        }
+        .tags { margin-top: 48px; display: flex; gap: 16px; justify-content: center; flex-wrap: wrap; }
+        .tag {
+            font-size: 28px;
+            padding: 10px 24px;
+            border-radius: 999px;
+            border: 2px solid {{ text }};
+            opacity: 0.85;
+        }
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>{{ title }}</h1>
+        {% if tags %}<div class="tags">{% for tag in tags %}<span class="tag">#{{ tag }}</span>{% endfor %}</div>{% endif %}
+    </div>
+</body>
+</html>
+"""
+
+thumbnail_template = Environment(autoescape=True).from_string(THUMBNAIL_TEMPLATE)
+THUMBNAIL_TEMPLATE_HASH = hashlib.sha256((THUMBNAIL_TEMPLATE + json.dumps(THUMBNAIL_PALETTES)).encode('utf-8')).hexdigest()
+
+async def generate_template_thumbnail(project_path, project_summary, tags=None):
+    """Render thumbnail.html from the built-in Jinja2 template, then screenshot it"""
+    try:
+        project_path = Path(project_path)
+        thumbnail_html_path = project_path / "thumbnail.html"
+        thumbnail_png_path = project_path / "thumbnail.png"
+        title = project_summary.strip().strip('「」')
+        palette_index = int(hashlib.md5(project_path.name.encode('utf-8')).hexdigest(), 16) % len(THUMBNAIL_PALETTES)
+        start, end, text = THUMBNAIL_PALETTES[palette_index]
+        font_size = 80 if len(title) <= 12 else 64 if len(title) <= 20 else 52
+        thumbnail_html = thumbnail_template.render(
+            title=title,
+            tags=(tags or [])[:4],
+            start=start,
+            end=end,
+            text=text,
+            font_size=font_size
+        )
+        thumbnail_html_path.write_text(thumbnail_html, encoding='utf-8')
+        await thumbnail_browser_pool.screenshot(thumbnail_html_path, thumbnail_png_path)
+        if thumbnail_png_path.exists() and thumbnail_png_path.stat().st_size > 0:
+            logger.info(f"Template thumbnail success: {thumbnail_png_path.name} ({thumbnail_png_path.stat().st_size} bytes)")
+            return thumbnail_png_path
+        logger.warning("Template thumbnail screenshot missing or empty")
+        return None
     except ImportError:
         logger.error("Playwright is not installed. Run: playwright install chromium")
-        print("❌ Playwrightがインストールされていません。")
-        print("インストール方法:")
-        print("  pip install playwright")
-        print("  playwright install chromium")
         return None
     except Exception as e:
-        logger.error(f"Claude Code thumbnail generation error: {str(e)}", exc_info=True)
-        print(f"❌ Claude Code サムネイル生成エラー: {type(e).__name__}: {str(e)}")
-        import traceback
-        traceback.print_exc()
+        logger.error(f"Template thumbnail generation error: {str(e)}", exc_info=True)
         return None
-    finally:
-        if browser:
-            try:
-                await browser.close()
-            except:
-                pass
 
-async def generate_thumbnail_with_progress(project_summary, prompt, project_path):
-    """Generate thumbnail using Claude Code"""
+def resolve_thumbnail_mode(channel_id=None, channel_name=None, alias_tags=None):
+    """Pick the thumbnail mode for a request
+
+    An alias with a thumbnail column wins over the channel list in
+    THUMBNAIL_CLAUDE_CHANNELS, which wins over THUMBNAIL_MODE.
+    """
+    for tag in alias_tags or []:
+        mode = prompt_alias_thumbnail_modes.get(tag)
+        if mode:
+            return mode
+    claude_channels = [ch.strip() for ch in THUMBNAIL_CLAUDE_CHANNELS.split(',') if ch.strip()]
+    if (channel_name and channel_name in claude_channels) or (channel_id and str(channel_id) in claude_channels):
+        return THUMBNAIL_MODE_CLAUDE
+    return THUMBNAIL_MODE
+
+def thumbnail_fingerprint(project_summary, mode, tags=None):
+    """Hash of everything that changes how the thumbnail looks
+
+    The Claude-mode design only depends on the summary; the template also
+    shows the first tags and changes with the template and palettes.
+    """
+    if mode == THUMBNAIL_MODE_CLAUDE:
+        inputs = [mode, project_summary.strip()]
+    else:
+        inputs = [mode, project_summary.strip(), (tags or [])[:4], THUMBNAIL_TEMPLATE_HASH]
+    return hashlib.sha256(json.dumps(inputs, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+async def generate_thumbnail_with_progress(project_summary, prompt, project_path, mode=None, tags=None):
+    """Generate thumbnail from the built-in template, or with Claude Code in claude mode
+
+    The existing thumbnail.png is reused when its fingerprint (summary and
+    the other visible inputs) matches the one recorded when it was made and
+    the file is unchanged since, skipping the Claude run and the screenshot.
+    """
     if not project_path:
         raise Exception("Project path required for thumbnail generation")
-    log_info(f"Claude Code thumbnail generation for {project_path}")
-    thumbnail_path = await generate_claude_code_thumbnail(project_path, project_summary, prompt)
-    if not thumbnail_path:
-        raise Exception("Claude Code thumbnail generation failed")
+    mode = mode or THUMBNAIL_MODE
+    project_path = Path(project_path)
+    thumbnail_path = project_path / "thumbnail.png"
+    metadata = load_project_metadata(project_path.name)
+    thumbnail_sha = None
+    if thumbnail_path.exists() and metadata.get('thumbnail_fingerprint') == thumbnail_fingerprint(project_summary, mode, tags):
+        current_sha = await asyncio.to_thread(hash_file, thumbnail_path)
+        if current_sha == metadata.get('thumbnail_sha'):
+            thumbnail_sha = current_sha
+            annotate_span(reused=True)
+            log_info(f"Thumbnail unchanged for {project_path.name}, reusing thumbnail.png")
+    if not thumbnail_sha:
+        log_info(f"Thumbnail generation ({mode}) for {project_path}")
+        generated_path = None
+        used_mode = mode
+        if mode == THUMBNAIL_MODE_CLAUDE:
+            generated_path = await generate_claude_code_thumbnail(project_path, project_summary, prompt)
+            if not generated_path:
+                logger.warning("Claude Code thumbnail failed, falling back to template")
+        if not generated_path:
+            used_mode = THUMBNAIL_MODE_TEMPLATE
+            generated_path = await generate_template_thumbnail(project_path, project_summary, tags)
+        if not generated_path:
+            raise Exception("Thumbnail generation failed")
+        thumbnail_path = generated_path
+        thumbnail_sha = await asyncio.to_thread(hash_file, thumbnail_path)
+        # Record the mode actually used, so a template fallback is retried in claude mode next time
+        update_project_metadata(
+            project_path.name,
+            thumbnail_fingerprint=thumbnail_fingerprint(project_summary, used_mode, tags),
+            thumbnail_sha=thumbnail_sha
+        )
     relative_path = thumbnail_path.relative_to(Path(COMMAND_BASE_PATH))
     thumbnail_url = f"{PROJECT_BASE_URL.rstrip('/')}/{relative_path.as_posix()}" if PROJECT_BASE_URL else f"/{relative_path.as_posix()}"
-    log_info(f"Claude Code thumbnail generated successfully: {thumbnail_url}")
+    # Content-versioned URL, so the static server can mark it immutable
+    thumbnail_url += f"?v={thumbnail_sha[:12]}"
+    log_info(f"Thumbnail generated successfully: {thumbnail_url}")
     return thumbnail_url
 
-async def save_to_csv_gallery(project_id, summary, prompt, thumbnail_url=None, author_info=None):
-    """Save project to CSV gallery"""
+def write_thumbnail_variants(png_path):
+    """Write resized WebP (and AVIF if enabled) copies next to a thumbnail PNG
+
+    Produces thumbnail-<width>.<format> for each THUMBNAIL_VARIANT_WIDTHS
+    entry that does not upscale. Variants newer than the PNG are kept, so a
+    reused thumbnail is not re-encoded. Needs Pillow; blocking, run it in a
+    thread.
+
+    Returns:
+        dict: format -> list of (path, width)
+    """
+    from PIL import Image, features
+    formats = ['webp']
+    if THUMBNAIL_AVIF:
+        if features.check('avif'):
+            formats.append('avif')
+        else:
+            logger.warning("THUMBNAIL_AVIF is set but this Pillow build has no AVIF support")
+    png_path = Path(png_path)
+    png_mtime = png_path.stat().st_mtime_ns
+    variants = {image_format: [] for image_format in formats}
+    with Image.open(png_path) as source:
+        widths = [width for width in THUMBNAIL_VARIANT_WIDTHS if width <= source.width] or [source.width]
+        rgb = None
+        for width in widths:
+            resized = None
+            for image_format in formats:
+                target = png_path.with_name(f"{png_path.stem}-{width}.{image_format}")
+                variants[image_format].append((target, width))
+                if target.exists() and target.stat().st_mtime_ns >= png_mtime:
+                    continue
+                if resized is None:
+                    rgb = rgb or source.convert('RGB')
+                    height = round(rgb.height * width / rgb.width)
+                    resized = rgb if width == rgb.width else rgb.resize((width, height), Image.LANCZOS)
+                temp_path = target.with_name(target.name + '.tmp')
+                if image_format == 'webp':
+                    resized.save(temp_path, format='WEBP', quality=80, method=6)
+                else:
+                    resized.save(temp_path, format='AVIF', quality=55)
+                os.replace(temp_path, target)
+    return variants
+
+def thumbnail_srcsets(thumbnail_url, variants):
+    """srcset strings for the variants, next to thumbnail_url and content-versioned"""
+    url_path = thumbnail_url.split('?', 1)[0]
+    base = url_path.rsplit('/', 1)[0] + '/' if '/' in url_path else ''
+    return {
+        image_format: ', '.join(f"{base}{path.name}?v={hash_file(path)[:12]} {width}w" for path, width in items)
+        for image_format, items in variants.items()
+    }
+
+async def generate_thumbnail_variants(thumbnail_path, thumbnail_url):
+    """Derive the responsive WebP/AVIF images for a thumbnail
+
+    Returns:
+        dict: format -> srcset string; empty when Pillow is not installed
+    """
     try:
-        csv_path = Path(COMMAND_BASE_PATH) / "projects.csv"
+        variants = await asyncio.to_thread(write_thumbnail_variants, thumbnail_path)
+    except ImportError:
+        logger.warning("Pillow is not installed; skipping thumbnail variants")
+        return {}
+    srcsets = await asyncio.to_thread(thumbnail_srcsets, thumbnail_url, variants)
+    total = sum(path.stat().st_size for items in variants.values() for path, _ in items)
+    logger.info(f"Thumbnail variants written: {', '.join(srcsets)} ({total} bytes total)")
+    return srcsets
 
-        # Generate tags using AI
-        tags = await generate_tags_with_ai(summary, prompt)
+GALLERY_CSV_FIELDS = ['url', 'title', 'image_url', 'created_at', 'tags', 'author', 'channel', 'image_srcset', 'image_avif_srcset']
+
+class GalleryStore:
+    """SQLite-backed gallery keyed by project ID
+
+    Upserts are atomic and safe across concurrent jobs. projects.csv is
+    regenerated from the database for the static gallery frontend.
+    """
+
+    def __init__(self, db_path, csv_path):
+        self.db_path = Path(db_path)
+        self.csv_path = Path(csv_path)
+        self._lock = threading.Lock()
+        self._conn = None
+        self._export_task = None
+        self._export_dirty = False
+        self.version = 0
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS projects (
+                project_id TEXT PRIMARY KEY,
+                url TEXT NOT NULL,
+                title TEXT NOT NULL,
+                image_url TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                tags TEXT NOT NULL DEFAULT '',
+                author TEXT NOT NULL DEFAULT '',
+                channel TEXT NOT NULL DEFAULT '',
+                image_srcset TEXT NOT NULL DEFAULT '',
+                image_avif_srcset TEXT NOT NULL DEFAULT ''
+            )""")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(projects)")}
+            for column in ('image_srcset', 'image_avif_srcset'):
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE projects ADD COLUMN {column} TEXT NOT NULL DEFAULT ''")
+            self._conn = conn
+            if conn.execute("SELECT COUNT(*) FROM projects").fetchone()[0] == 0:
+                self._import_csv()
+        return self._conn
+
+    def _import_csv(self):
+        """One-time migration of rows from an existing projects.csv"""
+        if not self.csv_path.exists():
+            return
+        imported = 0
+        with open(self.csv_path, 'r', encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                url = row.get('url') or ''
+                project_id = extract_project_id_from_url(url)
+                if not project_id:
+                    continue
+                created_at = row.get('created_at') or datetime.now().isoformat()
+                self._conn.execute(
+                    """INSERT OR REPLACE INTO projects
+                    (project_id, url, title, image_url, created_at, updated_at, tags, author, channel,
+                     image_srcset, image_avif_srcset)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    (project_id, url, row.get('title') or '', row.get('image_url') or '', created_at,
+                     created_at, row.get('tags') or '', row.get('author') or '', row.get('channel') or '',
+                     row.get('image_srcset') or '', row.get('image_avif_srcset') or '')
+                )
+                imported += 1
+        self._conn.commit()
+        logger.info(f"Gallery store imported {imported} rows from {self.csv_path.name}")
+
+    def upsert(self, project_id, url, title, image_url, tags, author, channel, image_srcset='', image_avif_srcset=''):
+        """Insert or update a project row; created_at is kept on update
+
+        Returns:
+            bool: True if the project already existed
+        """
+        now = datetime.now().isoformat()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                existed = conn.execute("SELECT 1 FROM projects WHERE project_id = ?", (project_id,)).fetchone() is not None
+                conn.execute(
+                    """INSERT INTO projects
+                    (project_id, url, title, image_url, created_at, updated_at, tags, author, channel,
+                     image_srcset, image_avif_srcset)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT(project_id) DO UPDATE SET
+                        url = excluded.url, title = excluded.title, image_url = excluded.image_url,
+                        updated_at = excluded.updated_at, tags = excluded.tags,
+                        author = excluded.author, channel = excluded.channel,
+                        image_srcset = excluded.image_srcset, image_avif_srcset = excluded.image_avif_srcset""",
+                    (project_id, url, title, image_url, now, now, tags, author, channel, image_srcset, image_avif_srcset)
+                )
+            self.version += 1
+        return existed
+
+    def set_image_variants(self, project_id, image_srcset, image_avif_srcset):
+        """Attach derived thumbnail srcsets to an existing row"""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                updated = conn.execute(
+                    "UPDATE projects SET image_srcset = ?, image_avif_srcset = ? WHERE project_id = ?",
+                    (image_srcset, image_avif_srcset, project_id)
+                ).rowcount
+            self.version += 1
+        return updated > 0
+
+    def rows(self):
+        """All rows in insertion order"""
+        with self._lock:
+            return [dict(row) for row in self._connect().execute("SELECT * FROM projects ORDER BY rowid")]
+
+    def export_csv(self):
+        """Write projects.csv from the database via a temp file and atomic rename"""
+        rows = self.rows()
+        tmp_path = self.csv_path.with_name(self.csv_path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=GALLERY_CSV_FIELDS, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, self.csv_path)
+        return len(rows)
+
+    def schedule_export(self, delay=1.0):
+        """Export the CSV shortly after the last change, batching bursts of upserts
+
+        A change that lands while an export is already writing marks the
+        store dirty, and the running task exports once more afterwards.
+        """
+        self._export_dirty = True
+        if self._export_task and not self._export_task.done():
+            return
+        self._export_task = asyncio.create_task(self._delayed_export(delay))
+
+    async def _delayed_export(self, delay):
+        while self._export_dirty:
+            await asyncio.sleep(delay)
+            self._export_dirty = False
+            try:
+                count = await asyncio.to_thread(self.export_csv)
+                logger.debug(f"Gallery CSV exported ({count} rows)")
+            except Exception as e:
+                logger.error(f"Gallery CSV export error: {e}", exc_info=True)
+
+gallery_store = GalleryStore(Path(COMMAND_BASE_PATH) / ".gallery.sqlite3", Path(COMMAND_BASE_PATH) / "projects.csv")
+
+def backfill_thumbnail_variants():
+    """Create WebP/AVIF variants for every gallery row that has a thumbnail.png
+
+    Used from the command line for projects made before variants existed.
+    """
+    updated = 0
+    for row in gallery_store.rows():
+        png_path = Path(COMMAND_BASE_PATH) / row['project_id'] / "thumbnail.png"
+        if not png_path.exists() or not row['image_url'] or 'placeholder' in row['image_url']:
+            continue
+        try:
+            srcsets = thumbnail_srcsets(row['image_url'], write_thumbnail_variants(png_path))
+        except ImportError:
+            return "Pillow is not installed (pip install Pillow)"
+        except Exception as e:
+            logger.warning(f"Thumbnail variants failed for {row['project_id']}: {e}")
+            continue
+        gallery_store.set_image_variants(row['project_id'], srcsets.get('webp', ''), srcsets.get('avif', ''))
+        updated += 1
+    gallery_store.export_csv()
+    return f"Thumbnail variants written for {updated} projects"
+
+class GalleryIndex:
+    """In-memory index over gallery rows for the paginated gallery API
+
+    Rows are kept newest first with lookup sets by tag, author and channel.
+    Search matches substrings of the title and tags and uses a character
+    bigram index to narrow the candidates, which also works for Japanese
+    text. The index is rebuilt lazily after gallery_store changes.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.version = None
+        self.build_id = ''
+        self.entries = []
+        self.keys = []
+        self.by_tag = {}
+        self.by_author = {}
+        self.by_channel = {}
+        self.bigrams = {}
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _bigrams(text):
+        return {text[i:i + 2] for i in range(len(text) - 1)}
+
+    def _build(self, rows):
+        entries = []
+        for row in rows:
+            tags = [tag.strip() for tag in (row.get('tags') or '').split(';') if tag.strip()]
+            entry = {
+                'project_id': row['project_id'],
+                'url': row['url'],
+                'title': row['title'],
+                'image_url': row['image_url'],
+                'created_at': row['created_at'],
+                'tags': tags,
+                'author': row.get('author') or '',
+                'channel': row.get('channel') or '',
+                'image_srcset': row.get('image_srcset') or '',
+                'image_avif_srcset': row.get('image_avif_srcset') or '',
+            }
+            entry['_search'] = ' '.join([entry['title']] + tags).lower()
+            entries.append(entry)
+        entries.sort(key=lambda entry: (entry['created_at'], entry['project_id']), reverse=True)
+        by_tag, by_author, by_channel, bigrams = {}, {}, {}, {}
+        for position, entry in enumerate(entries):
+            for tag in entry['tags']:
+                by_tag.setdefault(tag.lower(), set()).add(position)
+            by_author.setdefault(entry['author'], set()).add(position)
+            by_channel.setdefault(entry['channel'], set()).add(position)
+            for gram in self._bigrams(entry['_search']):
+                bigrams.setdefault(gram, set()).add(position)
+        self.build_id = uuid.uuid4().hex[:12]
+        self.entries = entries
+        self.keys = [(entry['created_at'], entry['project_id']) for entry in entries]
+        self.by_tag, self.by_author, self.by_channel, self.bigrams = by_tag, by_author, by_channel, bigrams
+
+    async def refresh(self):
+        async with self._lock:
+            version = self.store.version
+            if version != self.version:
+                rows = await asyncio.to_thread(self.store.rows)
+                self._build(rows)
+                self.version = version
+        return self
+
+    @staticmethod
+    def encode_cursor(entry):
+        raw = json.dumps([entry['created_at'], entry['project_id']], ensure_ascii=False)
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor):
+        padded = cursor + '=' * (-len(cursor) % 4)
+        position = json.loads(base64.urlsafe_b64decode(padded).decode('utf-8'))
+        if not isinstance(position, list) or len(position) != 2:
+            raise ValueError('invalid cursor')
+        created_at, project_id = position
+        return str(created_at), str(project_id)
+
+    def _matching(self, q=None, tag=None, author=None, channel=None):
+        """Positions matching every filter, or None when there is no filter"""
+        candidates = None
+
+        def narrow(positions):
+            nonlocal candidates
+            candidates = set(positions) if candidates is None else candidates & positions
+
+        if tag:
+            narrow(self.by_tag.get(tag.lower(), set()))
+        if author:
+            narrow(self.by_author.get(author, set()))
+        if channel:
+            narrow(self.by_channel.get(channel, set()))
+        if q:
+            query = q.lower().strip()
+            grams = self._bigrams(query)
+            for gram in grams:
+                narrow(self.bigrams.get(gram, set()))
+            if not grams:
+                narrow(range(len(self.entries)))
+            candidates = {position for position in candidates if query in self.entries[position]['_search']}
+        return candidates
+
+    def _position_after(self, key):
+        """First position whose sort key is below key (keys are newest first)"""
+        low, high = 0, len(self.keys)
+        while low < high:
+            middle = (low + high) // 2
+            if self.keys[middle] >= key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, q=None, tag=None, author=None, channel=None, since=None, until=None, cursor=None, limit=24):
+        """One page of matching rows, newest first
+
+        since/until bound created_at (ISO strings, until exclusive).
+
+        Returns:
+            dict: items, next_cursor (None on the last page) and total
+        """
+        matching = self._matching(q, tag, author, channel)
+        positions = range(len(self.entries)) if matching is None else sorted(matching)
+        if since or until:
+            positions = [
+                position for position in positions
+                if (not since or self.entries[position]['created_at'] >= since)
+                and (not until or self.entries[position]['created_at'] < until)
+            ]
+        start = bisect.bisect_left(positions, self._position_after(self.decode_cursor(cursor))) if cursor else 0
+        page = positions[start:start + limit + 1]
+        items = [{key: value for key, value in self.entries[position].items() if not key.startswith('_')}
+                 for position in page[:limit]]
+        next_cursor = self.encode_cursor(items[-1]) if len(page) > limit else None
+        return {'items': items, 'next_cursor': next_cursor, 'total': len(positions)}
+
+    def facets(self):
+        """Counts for the gallery sidebar and header"""
+        return {
+            'total': len(self.entries),
+            'latest': self.entries[0]['created_at'] if self.entries else None,
+            'tag_count': len(self.by_tag),
+            'channels': {channel: len(positions) for channel, positions in sorted(self.by_channel.items()) if channel},
+            'authors': {author: len(positions) for author, positions in sorted(self.by_author.items()) if author},
+        }
+
+gallery_index = GalleryIndex(gallery_store)
+
+async def save_to_csv_gallery(project_id, summary, prompt, thumbnail_url=None, author_info=None, tags=None, image_srcsets=None):
+    """Save project to the gallery store and refresh projects.csv"""
+    try:
         tags_str = ';'.join(tags) if tags else ''
 
         # Get project URL
@@ -604,90 +1780,207 @@ async def save_to_csv_gallery(project_id, summary, prompt, thumbnail_url=None, a
             author_name = author_info.get('display_name', '') or author_info.get('username', '')
             channel_name = author_info.get('channel_name', '')
 
-        # Get created_at: check CSV for existing entry, otherwise use current time
-        created_at = datetime.now().isoformat()
-        csv_exists = csv_path.exists()
-        existing_rows = []
-        project_exists = False
-
-        if csv_exists:
-            try:
-                with open(csv_path, 'r', encoding='utf-8', newline='') as f:
-                    reader = csv.DictReader(f)
-                    for row in reader:
-                        if row.get('url') == project_url:
-                            # Update existing project
-                            created_at = row.get('created_at', created_at)
-                            row['title'] = summary
-                            row['image_url'] = thumbnail_url
-                            row['tags'] = tags_str
-                            row['author'] = author_name
-                            row['channel'] = channel_name
-                            project_exists = True
-                            print(f"プロジェクト {project_id} のCSVエントリを更新します")
-                        existing_rows.append(row)
-            except Exception as e:
-                print(f"CSV読み込みエラー: {e}")
-
-        # Write CSV
-        if project_exists:
-            with open(csv_path, 'w', encoding='utf-8', newline='') as f:
-                if existing_rows:
-                    fieldnames = ['url', 'title', 'image_url', 'created_at', 'tags', 'author', 'channel']
-                    writer = csv.DictWriter(f, fieldnames=fieldnames)
-                    writer.writeheader()
-                    writer.writerows(existing_rows)
-            print(f"プロジェクト {project_id} をCSVギャラリーで更新しました")
+        image_srcsets = image_srcsets or {}
+        existed = await asyncio.to_thread(
+            gallery_store.upsert,
+            project_id, project_url, summary, thumbnail_url, tags_str, author_name, channel_name,
+            image_srcsets.get('webp', ''), image_srcsets.get('avif', '')
+        )
+        gallery_store.schedule_export()
+        if existed:
+            logger.info(f"プロジェクト {project_id} をギャラリーで更新しました")
         else:
-            with open(csv_path, 'a', encoding='utf-8', newline='') as f:
-                writer = csv.writer(f)
-                if not csv_exists or csv_path.stat().st_size == 0:
-                    writer.writerow(['url', 'title', 'image_url', 'created_at', 'tags', 'author', 'channel'])
-                writer.writerow([
-                    project_url,
-                    summary,
-                    thumbnail_url,
-                    created_at,
-                    tags_str,
-                    author_name,
-                    channel_name
-                ])
-            print(f"プロジェクト {project_id} をCSVギャラリーに追加しました")
-
+            logger.info(f"プロジェクト {project_id} をギャラリーに追加しました")
         return True
     except Exception as e:
-        print(f"CSVギャラリー保存エラー: {e}")
+        logger.error(f"ギャラリー保存エラー: {e}", exc_info=True)
         return False
 
+# (attempts, first backoff in seconds); the backoff doubles after each failure
+STAGE_RETRY_POLICIES = {
+    'summary': (3, 2.0),
+    'thumbnail': (2, 5.0),
+    'thumbnail_variants': (2, 1.0),
+    'gallery_save': (3, 1.0),
+    'ogp_rewrite': (2, 1.0),
+}
+
+class StageCheckpoints:
+    """Per-stage completion markers kept in the project's .pipeline directory
+
+    job.json holds what is needed to re-run the post-Claude stages (prompt,
+    URL, author); each <stage>.json records whether that stage finished and
+    its result, so !retry only re-runs what failed.
+    """
+
+    def __init__(self, project_path):
+        self.path = Path(project_path) / PIPELINE_DIR_NAME
+
+    def _read(self, name):
+        try:
+            return json.loads((self.path / f"{name}.json").read_text(encoding='utf-8'))
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, name, data):
+        self.path.mkdir(parents=True, exist_ok=True)
+        target = self.path / f"{name}.json"
+        temp_path = target.with_suffix('.tmp')
+        temp_path.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+        os.replace(temp_path, target)
+
+    def start(self, **context):
+        """Clear the previous run's markers and store the new run's context"""
+        if self.path.exists():
+            shutil.rmtree(self.path)
+        self._write('job', context)
+
+    def context(self):
+        return self._read('job')
+
+    def marker(self, stage):
+        return self._read(stage) or {}
+
+    def is_done(self, stage):
+        return self.marker(stage).get('status') == 'done'
+
+    def mark_done(self, stage, result=None):
+        self._write(stage, {'status': 'done', 'result': result, 'at': datetime.now().isoformat()})
+
+    def mark_failed(self, stage, error, attempts):
+        self._write(stage, {'status': 'failed', 'error': error, 'attempts': attempts, 'at': datetime.now().isoformat()})
+
+    def clear(self, stage):
+        (self.path / f"{stage}.json").unlink(missing_ok=True)
+
+    def failed_stages(self):
+        return [stage for stage in STAGE_RETRY_POLICIES if self.marker(stage).get('status') == 'failed']
+
+async def run_stage(checkpoints, stage, func, *args, **attributes):
+    """Run one pipeline stage with its retry policy and checkpoint the result
+
+    A stage already marked done returns its stored result without running.
+    func must return a JSON-serialisable result.
+    """
+    if checkpoints.is_done(stage):
+        logger.info(f"Stage {stage} already done, reusing checkpoint")
+        return checkpoints.marker(stage).get('result')
+    attempts, delay = STAGE_RETRY_POLICIES.get(stage, (1, 0))
+    for attempt in range(1, attempts + 1):
+        try:
+            with pipeline_stage(stage, attempt=attempt, **attributes):
+                result = await func(*args)
+            checkpoints.mark_done(stage, result)
+            return result
+        except Exception as e:
+            if attempt == attempts:
+                checkpoints.mark_failed(stage, f"{type(e).__name__}: {e}", attempt)
+                raise
+            logger.warning(f"Stage {stage} failed (attempt {attempt}/{attempts}), retrying in {delay:.0f}s: {e}")
+            await asyncio.sleep(delay)
+            delay *= 2
+
+async def generate_summary_stage(project_path, prompt):
+    summary, tags = await generate_project_metadata_with_ai(project_path, prompt)
+    return [summary, tags]
+
+async def gallery_save_stage(project_id, summary, prompt, thumbnail_url, author_info, tags, image_srcsets=None):
+    if not await save_to_csv_gallery(project_id, summary, prompt, thumbnail_url, author_info, tags, image_srcsets):
+        raise Exception("Gallery save failed")
+
+async def ogp_rewrite_stage(project_path, summary, project_url, thumbnail_url):
+    if not await update_html_meta_tags(project_path, summary, project_url, thumbnail_url):
+        raise Exception("OGP meta tag rewrite failed")
+
+async def run_post_processing(project_id, project_path, summary, tags, prompt, project_url, has_html, author_info, thumbnail_mode=None):
+    """Run the post-Claude stages concurrently where their inputs allow
+
+    The thumbnail only needs the summary and tags. The OGP rewrite and the
+    gallery save both need the thumbnail URL and run side by side. Each
+    stage is retried and checkpointed, so !retry resumes at the failed one.
+    Missing WebP/AVIF variants only cost bandwidth, so that stage failing
+    does not block the gallery save; it is still reported as a failure,
+    and re-running it also re-saves the gallery row with the new srcsets.
+    """
+    checkpoints = StageCheckpoints(project_path)
+    thumbnail_url = await run_stage(
+        checkpoints, 'thumbnail', generate_thumbnail_with_progress,
+        summary, prompt, project_path, thumbnail_mode, tags, mode=thumbnail_mode
+    )
+    if not checkpoints.is_done('thumbnail_variants'):
+        checkpoints.clear('gallery_save')
+    variants_error = None
+    try:
+        image_srcsets = await run_stage(
+            checkpoints, 'thumbnail_variants', generate_thumbnail_variants,
+            Path(project_path) / "thumbnail.png", thumbnail_url
+        )
+    except Exception as e:
+        logger.warning(f"Thumbnail variants failed, gallery will use the PNG: {e}")
+        variants_error = e
+        image_srcsets = {}
+    stages = [run_stage(
+        checkpoints, 'gallery_save', gallery_save_stage,
+        project_id, summary, prompt, thumbnail_url, author_info, tags, image_srcsets
+    )]
+    if has_html:
+        stages.append(run_stage(
+            checkpoints, 'ogp_rewrite', ogp_rewrite_stage,
+            project_path, summary, project_url, thumbnail_url
+        ))
+    results = await asyncio.gather(*stages, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    if variants_error:
+        raise variants_error
+    return thumbnail_url
+
+async def terminate_process(process):
+    """SIGTERM a process, escalating to SIGKILL if it doesn't exit"""
+    try:
+        process.terminate()
+        await asyncio.wait_for(process.wait(), timeout=5)
+        logger.info("Process terminated via SIGTERM")
+    except asyncio.TimeoutError:
+        process.kill()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=2)
+            logger.warning("Process killed via SIGKILL (did not respond to SIGTERM)")
+        except asyncio.TimeoutError:
+            logger.error("Process zombie (no response to SIGKILL)")
+    except ProcessLookupError:
+        pass
+
+async def spawn_shell(command, cwd, **kwargs):
+    """Start a shell command with piped output and track it for metrics"""
+    process = await asyncio.create_subprocess_shell(
+        command,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        cwd=cwd,
+        **kwargs
+    )
+    active_subprocesses.add(process)
+    annotate_span(pid=process.pid)
+    return process
+
 async def execute_command_with_timeout(command, cwd, timeout=300):
     """Execute a command with timeout and return output with proper cleanup"""
     process = None
     try:
-        process = await asyncio.create_subprocess_shell(
-            command,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=cwd
-        )
+        process = await spawn_shell(command, cwd)
         try:
             stdout, stderr = await asyncio.wait_for(
                 process.communicate(),
                 timeout=timeout
             )
+            annotate_span(exit_code=process.returncode)
             return stdout.decode('utf-8', errors='ignore'), stderr.decode('utf-8', errors='ignore'), process.returncode
         except asyncio.TimeoutError:
             logger.warning(f"Command timeout after {timeout}s, attempting termination...")
-            try:
-                process.terminate()
-                await asyncio.wait_for(process.wait(), timeout=5)
-                logger.info("Process terminated via SIGTERM")
-            except asyncio.TimeoutError:
-                process.kill()
-                try:
-                    await asyncio.wait_for(process.wait(), timeout=2)
-                    logger.warning("Process killed via SIGKILL (did not respond to SIGTERM)")
-                except asyncio.TimeoutError:
-                    logger.error("Process zombie (no response to SIGKILL)")
+            await terminate_process(process)
+            annotate_span(exit_code=-1, timed_out=True)
             try:
                 stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=3)
                 return stdout.decode('utf-8', errors='ignore'), stderr.decode('utf-8', errors='ignore'), -1
@@ -704,6 +1997,219 @@ async def execute_command_with_timeout(command, cwd, timeout=300):
                 pass
         return '', str(e), -1
 
+async def execute_command_streaming(command, cwd, timeout=600, log_path=None, on_line=None, tail_lines=200):
+    """Execute a command, reading stdout and stderr line by line as they arrive
+
+    Every line is appended to log_path; only the last tail_lines lines of
+    each stream are kept in memory. on_line(stream_name, line) is called
+    for each line so callers can report progress.
+
+    Returns:
+        tuple: (stdout_tail, stderr_tail, returncode)
+    """
+    process = None
+    stdout_tail = collections.deque(maxlen=tail_lines)
+    stderr_tail = collections.deque(maxlen=tail_lines)
+    log_file = None
+    try:
+        if log_path:
+            Path(log_path).parent.mkdir(parents=True, exist_ok=True)
+            log_file = open(log_path, 'a', encoding='utf-8')
+        process = await spawn_shell(command, cwd, limit=STREAM_LINE_LIMIT)
+
+        async def read_line(stream):
+            """Next line; one longer than STREAM_LINE_LIMIT is discarded and returned truncated"""
+            try:
+                return await stream.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                return e.partial
+            except asyncio.LimitOverrunError as e:
+                head = await stream.readexactly(e.consumed)
+                skipped = len(head)
+                while True:
+                    try:
+                        skipped += len(await stream.readuntil(b'\n'))
+                        break
+                    except asyncio.IncompleteReadError as tail:
+                        skipped += len(tail.partial)
+                        break
+                    except asyncio.LimitOverrunError as more:
+                        skipped += len(await stream.readexactly(more.consumed))
+                logger.warning(f"Skipped an oversized output line ({skipped} bytes)")
+                return head[:1000] + f' ... [truncated {skipped} bytes]\n'.encode()
+
+        async def pump(stream, name, tail):
+            while True:
+                raw = await read_line(stream)
+                if not raw:
+                    break
+                line = raw.decode('utf-8', errors='ignore').rstrip('\n')
+                tail.append(line)
+                if log_file:
+                    log_file.write(f"[{name}] {line}\n")
+                if on_line:
+                    try:
+                        on_line(name, line)
+                    except Exception as callback_error:
+                        logger.warning(f"Stream callback error: {callback_error}")
+
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(
+                    pump(process.stdout, 'stdout', stdout_tail),
+                    pump(process.stderr, 'stderr', stderr_tail),
+                    process.wait()
+                ),
+                timeout=timeout
+            )
+            returncode = process.returncode
+        except asyncio.TimeoutError:
+            logger.warning(f"Command timeout after {timeout}s, attempting termination...")
+            await terminate_process(process)
+            stderr_tail.append(f'Command timed out after {timeout} seconds (forced termination)')
+            returncode = -1
+        annotate_span(exit_code=returncode, timed_out=returncode == -1)
+        return '\n'.join(stdout_tail), '\n'.join(stderr_tail), returncode
+    except Exception as e:
+        logger.error(f"Command execution error: {e}", exc_info=True)
+        if process and process.returncode is None:
+            try:
+                process.kill()
+                await asyncio.wait_for(process.wait(), timeout=2)
+            except:
+                pass
+        return '\n'.join(stdout_tail), str(e), -1
+    finally:
+        if log_file:
+            log_file.close()
+
+class ClaudeStreamParser:
+    """Turns `claude --output-format stream-json` events into progress lines
+
+    The final answer from the result event is kept as result_text; other
+    events are reduced to short human-readable progress lines.
+    """
+
+    def __init__(self):
+        self.result_text = None
+        self.session_id = None
+        self.is_error = False
+
+    def feed(self, line):
+        """Parse one stdout line; return a progress line or None"""
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return line.strip() or None
+        if not isinstance(event, dict):
+            return None
+        self.session_id = event.get('session_id') or self.session_id
+        event_type = event.get('type')
+        if event_type == 'result':
+            self.result_text = event.get('result') or ''
+            self.is_error = bool(event.get('is_error'))
+            return '🏁 完了' if not self.is_error else '⚠️ エラーで終了'
+        if event_type != 'assistant':
+            return None
+        progress = []
+        for item in event.get('message', {}).get('content', []):
+            if item.get('type') == 'text' and item.get('text', '').strip():
+                progress.append('💬 ' + item['text'].strip().splitlines()[0][:150])
+            elif item.get('type') == 'tool_use':
+                tool_input = item.get('input', {})
+                target = tool_input.get('file_path') or tool_input.get('command') or tool_input.get('pattern') or ''
+                progress.append(f"🔧 {item.get('name', 'tool')} {str(target)[:120]}".rstrip())
+        return '\n'.join(progress) or None
+
+CLAUDE_SESSION_ID_PATTERN = re.compile(r'[0-9A-Za-z-]{8,64}')
+
+def resumable_claude_session(project_id):
+    """Session ID of the project's last successful Claude run, if still fresh
+
+    Session IDs come from the stream-json output, so resuming needs
+    CLAUDE_STREAM_JSON. Sessions older than CLAUDE_SESSION_MAX_AGE_HOURS
+    start cold, as do IDs that don't look like a session ID.
+    """
+    if not (CLAUDE_SESSION_RESUME and CLAUDE_STREAM_JSON):
+        return None
+    metadata = load_project_metadata(project_id)
+    session_id = metadata.get('claude_session_id')
+    updated_at = metadata.get('claude_session_updated_at') or 0
+    if not session_id or not CLAUDE_SESSION_ID_PATTERN.fullmatch(session_id):
+        return None
+    if time.time() - updated_at > CLAUDE_SESSION_MAX_AGE_HOURS * 3600:
+        logger.info(f"Claude session for {project_id} is older than {CLAUDE_SESSION_MAX_AGE_HOURS}h, starting cold")
+        return None
+    return session_id
+
+CLAUDE_SESSION_MISSING_PATTERN = re.compile(r'No conversation found', re.IGNORECASE)
+
+def claude_session_missing(stdout, stderr, returncode):
+    """True when a --resume run failed because the CLI no longer has the session
+
+    Only the CLI's missing-session error counts. Timeouts, rate limits and
+    other failures keep the stored session and are reported as failures.
+    """
+    if returncode in (0, -1):
+        return False
+    return CLAUDE_SESSION_MISSING_PATTERN.search(f"{stderr}\n{stdout}") is not None
+
+class ProgressReporter:
+    """Keeps one Discord message updated with the latest progress lines
+
+    Edits are rate-limited to one per interval seconds.
+    """
+
+    def __init__(self, channel, title, interval=PROGRESS_EDIT_INTERVAL, max_lines=12):
+        self.channel = channel
+        self.title = title
+        self.interval = interval
+        self.lines = collections.deque(maxlen=max_lines)
+        self.message = None
+        self._dirty = False
+        self._task = None
+        self._started_at = time.time()
+
+    def add(self, text):
+        for line in text.splitlines():
+            self.lines.append(line)
+        self._dirty = True
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self._flush()
+
+    def _render(self):
+        elapsed = int(time.time() - self._started_at)
+        body = '\n'.join(self.lines) or '(待機中)'
+        return f"{self.title} ({elapsed // 60}分{elapsed % 60:02d}秒経過)\n```\n{body[-1800:]}\n```"
+
+    async def _flush(self):
+        if not self._dirty and self.message:
+            return
+        self._dirty = False
+        try:
+            with DISCORD_SEND_DURATION.time(operation='progress_edit'):
+                if self.message:
+                    await self.message.edit(content=self._render())
+                else:
+                    self.message = await self.channel.send(self._render(), silent=True)
+        except Exception as e:
+            logger.warning(f"Progress update failed: {e}")
+
+    async def _loop(self):
+        while True:
+            await self._flush()
+            await asyncio.sleep(self.interval)
+
 def split_message(text, max_length=1990):
     """Split long messages into chunks"""
     if len(text) <= max_length:
@@ -727,16 +2233,787 @@ def split_message(text, max_length=1990):
         chunks.append(current_chunk)
     return chunks
 
+class JobQueueFullError(Exception):
+    """Raised when the Claude job queue has no free slot"""
+
+class UserQuotaExceededError(Exception):
+    """Raised when a user has too many queued jobs or used up the hourly cap"""
+
+    def __init__(self, limit, retry_after=None):
+        super().__init__(limit)
+        self.limit = limit
+        self.retry_after = retry_after
+
+def parse_priority_mapping(value):
+    """Parse 'key=value,key=value' settings such as CLAUDE_PRIORITY_CHANNELS"""
+    mapping = {}
+    for item in value.split(','):
+        key, sep, val = item.partition('=')
+        if sep and key.strip() and val.strip():
+            mapping[key.strip()] = val.strip().lower()
+    return mapping
+
+priority_weights = {name: float(weight) for name, weight in parse_priority_mapping(CLAUDE_PRIORITY_WEIGHTS).items()}
+priority_weights.setdefault('normal', 1.0)
+priority_channels = parse_priority_mapping(CLAUDE_PRIORITY_CHANNELS)
+priority_roles = parse_priority_mapping(CLAUDE_PRIORITY_ROLES)
+
+def resolve_job_priority(ctx, alias_tags=None):
+    """Pick the priority class for a request
+
+    Candidates come from the aliases' priority column, the channel in
+    CLAUDE_PRIORITY_CHANNELS and the author's roles in
+    CLAUDE_PRIORITY_ROLES; the class with the largest weight wins.
+    """
+    candidates = [prompt_alias_priorities[tag] for tag in alias_tags or [] if tag in prompt_alias_priorities]
+    for key in (str(ctx.channel.id), getattr(ctx.channel, 'name', None)):
+        if key in priority_channels:
+            candidates.append(priority_channels[key])
+    for role in getattr(ctx.author, 'roles', []):
+        for key in (str(role.id), role.name):
+            if key in priority_roles:
+                candidates.append(priority_roles[key])
+    candidates = [name for name in candidates if name in priority_weights]
+    return max(candidates, key=lambda name: priority_weights[name], default='normal')
+
+class ClaudeJob:
+    """A !claude request waiting for or occupying a worker slot"""
+
+    def __init__(self, ctx, project_id, prompt, coalescable=False, thumbnail_mode=None, priority='normal'):
+        self.ctx = ctx
+        self.project_id = project_id
+        self.request_id = uuid.uuid4().hex[:16]
+        self.user_id = str(ctx.author.id)
+        self.priority = priority
+        self.virtual_start = 0.0
+        self.virtual_finish = 0.0
+        self.thumbnail_mode = thumbnail_mode
+        self.prompts = [prompt]
+        self.followers = []
+        self.coalescable = coalescable
+        self.coalesced_into = None
+        self.status_msg = None
+        self.status_ready = asyncio.Event()
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.completed_stages = set()
+        self.stage_data = {}
+
+    @property
+    def prompt(self):
+        """Prompt for the run; coalesced follow-ups are applied in order"""
+        if len(self.prompts) == 1:
+            return self.prompts[0]
+        numbered = "\n\n".join(f"【指示{i}】\n{p}" for i, p in enumerate(self.prompts, 1))
+        return f"以下の{len(self.prompts)}件の指示を順番にすべて反映してください。\n\n{numbered}"
+
+    @property
+    def messages(self):
+        """Original Discord messages of this job and all coalesced follow-ups"""
+        return [self.ctx.message] + [follower.ctx.message for follower in self.followers]
+
+    @classmethod
+    def from_journal(cls, record, contexts):
+        """Rebuild a job from its journal record and re-fetched message contexts"""
+        job = cls(contexts[0], record['project_id'], record['prompts'][0],
+                  coalescable=record['coalescable'] and not record['completed_stages'],
+                  thumbnail_mode=record['thumbnail_mode'],
+                  priority=resolve_job_priority(contexts[0]))
+        job.request_id = record['request_id']
+        job.prompts = list(record['prompts'])
+        job.followers = [cls(follower_ctx, record['project_id'], '') for follower_ctx in contexts[1:]]
+        job.completed_stages = set(record['completed_stages'])
+        job.stage_data = dict(record['data'])
+        return job
+
+    def merge(self, other):
+        """Fold a follow-up request for the same project into this queued job"""
+        self.prompts.append(other.prompt)
+        self.followers.append(other)
+        other.coalesced_into = self
+
+class RetryJob(ClaudeJob):
+    """A !retry request: re-runs failed post-processing stages only
+
+    Goes through the scheduler like any other job so it never overlaps a
+    Claude run on the same project.
+    """
+
+    def __init__(self, ctx, project_id):
+        super().__init__(ctx, project_id, '', priority=resolve_job_priority(ctx))
+
+class ClaudeJobScheduler:
+    """Bounded fair-share queue drained by a fixed number of worker tasks
+
+    Limits how many Claude Code processes run at once so a burst of
+    requests waits in line instead of exhausting the VPS memory.
+
+    Pending jobs are ordered by weighted fair queuing across users: each
+    job gets a virtual finish time of max(virtual clock, the user's last
+    finish) + 1 / weight, where the weight comes from its priority class.
+    A user who queues many jobs only pushes back their own later jobs,
+    and higher classes get a larger share without starving lower ones.
+    Per-user caps bound running jobs, queued jobs and hourly submissions.
+    """
+
+    def __init__(self, max_workers, max_queued, estimate_seconds,
+                 max_running_per_user=1, max_queued_per_user=3, max_per_user_hour=0):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.max_running_per_user = max_running_per_user
+        self.max_queued_per_user = max_queued_per_user
+        self.max_per_user_hour = max_per_user_hour
+        self.pending = []
+        self.running = []
+        self.recent_durations = []
+        self.estimate_seconds = estimate_seconds
+        self.worker_tasks = []
+        self.virtual_time = 0.0
+        self.user_finish = {}
+        self.user_submissions = collections.defaultdict(collections.deque)
+        self._condition = asyncio.Condition()
+
+    def start(self, handler):
+        """Start worker tasks (safe to call again on reconnect)"""
+        self.worker_tasks = [task for task in self.worker_tasks if not task.done()]
+        for i in range(len(self.worker_tasks), self.max_workers):
+            self.worker_tasks.append(asyncio.create_task(self._worker(i, handler)))
+        logger.info(f"Job scheduler started: {self.max_workers} workers, queue size {self.max_queued}")
+
+    def submit(self, job, ignore_limit=False):
+        """Enqueue a job and return how many jobs are ahead of it (0 = starts now)
+
+        Follow-up requests for a project that already has a queued job are
+        coalesced into that job instead of taking a new slot. ignore_limit
+        is used for jobs recovered from the journal and skips all caps.
+        """
+        now = time.time()
+        submissions = self.user_submissions[job.user_id]
+        while submissions and now - submissions[0] >= 3600:
+            submissions.popleft()
+        if not ignore_limit and self.max_per_user_hour and len(submissions) >= self.max_per_user_hour:
+            raise UserQuotaExceededError('hourly', retry_after=submissions[0] + 3600 - now)
+        if job.coalescable:
+            for queued in self.pending:
+                if queued.project_id == job.project_id and queued.coalescable:
+                    queued.merge(job)
+                    submissions.append(now)
+                    logger.info(f"JOB_COALESCED | ID: {job.project_id} | Prompts: {len(queued.prompts)}")
+                    return max(self.estimate_start(queued)[0], 1)
+        idle_workers = max(self.max_workers - len(self.running), 0)
+        if not ignore_limit:
+            if sum(1 for queued in self.pending if queued.user_id == job.user_id) >= self.max_queued_per_user:
+                raise UserQuotaExceededError('queued')
+            if len(self.pending) >= self.max_queued + idle_workers:
+                raise JobQueueFullError()
+        weight = priority_weights.get(job.priority, 1.0)
+        job.virtual_start = max(self.virtual_time, self.user_finish.get(job.user_id, 0.0))
+        job.virtual_finish = job.virtual_start + 1 / weight
+        self.user_finish[job.user_id] = job.virtual_finish
+        self.pending.append(job)
+        submissions.append(now)
+        asyncio.get_running_loop().create_task(self._notify())
+        position = self.estimate_start(job)[0]
+        logger.info(f"JOB_QUEUED | ID: {job.project_id} | Request: {job.request_id} | User: {job.user_id} | Priority: {job.priority} | Position: {position} | Running: {len(self.running)} | Pending: {len(self.pending)}")
+        return position
+
+    def dispatch_order(self, pending=None):
+        """Pending jobs in the order the fair queue would start them"""
+        pending = self.pending if pending is None else pending
+        return sorted(pending, key=lambda queued: (queued.virtual_finish, queued.enqueued_at))
+
+    def average_duration(self):
+        if not self.recent_durations:
+            return self.estimate_seconds
+        return sum(self.recent_durations) / len(self.recent_durations)
+
+    def estimate_start(self, job):
+        """Estimate (jobs ahead, seconds until start) for a pending job
+
+        Replays the dispatcher against the running set with the average job
+        duration, honouring the per-user and per-project limits, so a job
+        blocked behind its user's or project's current job is not reported
+        as starting now. Jobs ahead is 0 when the job would start at once.
+        """
+        job = job.coalesced_into or job
+        if job not in self.pending:
+            return 0, 0
+        average = self.average_duration()
+        now = time.time()
+        running = [(max(average - (now - active.started_at), 0), active) for active in self.running]
+        pending = list(self.pending)
+        clock = 0.0
+        started = 0
+        while pending:
+            while len(running) < self.max_workers:
+                candidate = self._next_runnable(pending, [active for _, active in running])
+                if candidate is None:
+                    break
+                if candidate is job:
+                    return (started + 1 if clock > 0 else 0), clock
+                pending.remove(candidate)
+                running.append((clock + average, candidate))
+                started += 1
+            if not running:
+                break
+            finish, finished = min(running, key=lambda entry: entry[0])
+            running.remove((finish, finished))
+            clock = max(clock, finish)
+        return started + 1, clock
+
+    def estimate_start_delay(self, job):
+        """Estimate seconds until the job gets a worker slot"""
+        return self.estimate_start(job)[1]
+
+    def _next_runnable(self, pending=None, running=None):
+        """Earliest fair-queue job whose project and user have room to run
+
+        Jobs of one project stay FIFO: only a project's oldest pending job
+        is eligible, so fair ordering never swaps jobs that could not be
+        coalesced (retries, recovered jobs).
+        """
+        pending = self.pending if pending is None else pending
+        running = self.running if running is None else running
+        busy_projects = {active.project_id for active in running}
+        running_per_user = collections.Counter(active.user_id for active in running)
+        oldest = {}
+        for queued in pending:
+            if queued.project_id not in oldest or queued.enqueued_at < oldest[queued.project_id].enqueued_at:
+                oldest[queued.project_id] = queued
+        for job in self.dispatch_order(pending):
+            if (oldest[job.project_id] is job and job.project_id not in busy_projects
+                    and running_per_user[job.user_id] < self.max_running_per_user):
+                return job
+        return None
+
+    async def _notify(self, all_workers=False):
+        async with self._condition:
+            if all_workers:
+                self._condition.notify_all()
+            else:
+                self._condition.notify()
+
+    async def _worker(self, index, handler):
+        while True:
+            async with self._condition:
+                await self._condition.wait_for(lambda: self._next_runnable() is not None)
+                job = self._next_runnable()
+                self.pending.remove(job)
+                self.virtual_time = max(self.virtual_time, job.virtual_start)
+                job.started_at = time.time()
+                self.running.append(job)
+            logger.info(f"JOB_START | Worker: {index} | ID: {job.project_id} | Waited: {job.started_at - job.enqueued_at:.1f}s")
+            try:
+                await handler(job)
+            except Exception as e:
+                logger.error(f"Job worker {index} error: {e}", exc_info=True)
+            finally:
+                self.running.remove(job)
+                self.recent_durations = (self.recent_durations + [time.time() - job.started_at])[-20:]
+                logger.info(f"JOB_END | Worker: {index} | ID: {job.project_id} | Duration: {time.time() - job.started_at:.1f}s")
+                await self._notify(all_workers=True)
+
+class JobJournal:
+    """Durable record of job state so queued and running jobs survive restarts
+
+    Each job row holds its prompts, the Discord messages to answer, its
+    state (queued, running, completed, degraded, failed), the pipeline stages
+    already completed and the data those stages produced.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                request_id TEXT PRIMARY KEY,
+                project_id TEXT NOT NULL,
+                state TEXT NOT NULL,
+                prompts TEXT NOT NULL,
+                message_refs TEXT NOT NULL,
+                coalescable INTEGER NOT NULL DEFAULT 0,
+                thumbnail_mode TEXT,
+                completed_stages TEXT NOT NULL DEFAULT '[]',
+                data TEXT NOT NULL DEFAULT '{}',
+                created_at TEXT NOT NULL,
+                updated_at TEXT NOT NULL
+            )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+            self._conn = conn
+        return self._conn
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                return conn.execute(sql, params).fetchall()
+
+    async def record(self, job, state='queued'):
+        """Insert or refresh a job, e.g. after a follow-up was coalesced into it"""
+        now = datetime.now().isoformat()
+        message_refs = [[message.channel.id, message.id] for message in job.messages]
+        await asyncio.to_thread(
+            self._execute,
+            """INSERT INTO jobs
+            (request_id, project_id, state, prompts, message_refs, coalescable, thumbnail_mode, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(request_id) DO UPDATE SET
+                state = CASE WHEN excluded.state = 'queued' THEN jobs.state ELSE excluded.state END,
+                prompts = excluded.prompts,
+                message_refs = excluded.message_refs, updated_at = excluded.updated_at""",
+            (job.request_id, job.project_id, state, json.dumps(job.prompts, ensure_ascii=False),
+             json.dumps(message_refs), int(job.coalescable), job.thumbnail_mode, now, now)
+        )
+
+    async def mark_stage(self, job, stage, **data):
+        """Record a completed stage and the data needed to skip it on resume"""
+        job.completed_stages.add(stage)
+        job.stage_data.update(data)
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET state = 'running', completed_stages = ?, data = ?, updated_at = ? WHERE request_id = ?",
+            (json.dumps(sorted(job.completed_stages)), json.dumps(job.stage_data, ensure_ascii=False),
+             datetime.now().isoformat(), job.request_id)
+        )
+
+    async def mark_state(self, request_id, state):
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET state = ?, updated_at = ? WHERE request_id = ?",
+            (state, datetime.now().isoformat(), request_id)
+        )
+
+    async def mark_degraded(self, job, failed_stages):
+        """Claude ran but post-processing failed; keep the stages for !retry"""
+        job.stage_data['failed_stages'] = failed_stages
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET state = 'degraded', data = ?, updated_at = ? WHERE request_id = ?",
+            (json.dumps(job.stage_data, ensure_ascii=False), datetime.now().isoformat(), job.request_id)
+        )
+
+    async def resolve_degraded(self, project_id):
+        """Mark a project's degraded jobs completed after a successful !retry"""
+        await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET state = 'completed', updated_at = ? WHERE project_id = ? AND state = 'degraded'",
+            (datetime.now().isoformat(), project_id)
+        )
+
+    async def prune(self, max_age_days):
+        """Delete completed and failed rows older than max_age_days
+
+        Degraded rows are kept until !retry resolves them.
+        """
+        cutoff = datetime.fromtimestamp(time.time() - max_age_days * 86400).isoformat()
+
+        def delete():
+            with self._lock:
+                conn = self._connect()
+                with conn:
+                    return conn.execute(
+                        "DELETE FROM jobs WHERE state IN ('completed', 'failed') AND updated_at < ?", (cutoff,)
+                    ).rowcount
+        return await asyncio.to_thread(delete)
+
+    async def unfinished(self):
+        """Jobs left queued or running by the previous process, oldest first"""
+        rows = await asyncio.to_thread(
+            self._execute,
+            "SELECT * FROM jobs WHERE state IN ('queued', 'running') ORDER BY created_at"
+        )
+        records = []
+        for row in rows:
+            record = dict(row)
+            for key in ('prompts', 'message_refs', 'completed_stages', 'data'):
+                record[key] = json.loads(record[key])
+            record['coalescable'] = bool(record['coalescable'])
+            records.append(record)
+        return records
+
+job_journal = JobJournal(Path(COMMAND_BASE_PATH) / ".jobs.sqlite3")
+
+async def recover_interrupted_jobs():
+    """Re-queue jobs that were queued or running when the bot last stopped
+
+    Jobs whose Claude run already finished resume at post-processing
+    instead of starting over.
+    """
+    for record in await job_journal.unfinished():
+        try:
+            contexts = []
+            for channel_id, message_id in record['message_refs']:
+                channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+                contexts.append(await bot.get_context(await channel.fetch_message(message_id)))
+        except Exception as e:
+            logger.warning(f"JOB_RECOVERY_SKIPPED | Request: {record['request_id']} | {e}")
+            await job_journal.mark_state(record['request_id'], 'failed')
+            continue
+        job = ClaudeJob.from_journal(record, contexts)
+        job_scheduler.submit(job, ignore_limit=True)
+        logger.info(f"JOB_RECOVERED | ID: {job.project_id} | Request: {job.request_id} | Stages: {sorted(job.completed_stages)}")
+        resume_note = '（Claude Code 実行済みのため後処理から）' if 'claude_run' in job.completed_stages else ''
+        try:
+            job.status_msg = await job.ctx.send(f'♻️ 再起動前のリクエストを再開します{resume_note}: `{job.project_id}`')
+        except Exception as e:
+            logger.warning(f"Failed to send recovery notice: {e}")
+        finally:
+            job.status_ready.set()
+
+alias_refresh_task = None
+web_server_task = None
+jobs_recovered = False
+job_scheduler = ClaudeJobScheduler(
+    CLAUDE_MAX_CONCURRENT_JOBS, CLAUDE_MAX_QUEUED_JOBS, CLAUDE_JOB_ESTIMATE_SECONDS,
+    CLAUDE_MAX_JOBS_PER_USER, CLAUDE_MAX_QUEUED_PER_USER, CLAUDE_MAX_JOBS_PER_USER_HOUR
+)
+QUEUE_DEPTH = Gauge('ccbot_job_queue_depth', 'Jobs waiting for a worker slot', lambda: len(job_scheduler.pending))
+JOBS_RUNNING = Gauge('ccbot_jobs_running', 'Jobs currently holding a worker slot', lambda: len(job_scheduler.running))
+
+class TokenBucket:
+    """Token bucket that makes callers wait instead of hitting a rate limit"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class MessageDispatcher:
+    """Outbound Discord sender with per-channel pacing and message packing
+
+    Consecutive parts are packed into as few messages as the 2000 character
+    limit allows, and logs above the attachment threshold are uploaded as a
+    single .txt file instead of a wall of messages.
+    """
+
+    MESSAGE_LIMIT = 2000
+
+    def __init__(self, rate, burst, attachment_threshold):
+        self.rate = rate
+        self.burst = burst
+        self.attachment_threshold = attachment_threshold
+        self.buckets = {}
+
+    def _bucket(self, channel):
+        channel_id = getattr(channel, 'id', id(channel))
+        if channel_id not in self.buckets:
+            self.buckets[channel_id] = TokenBucket(self.rate, self.burst)
+        return self.buckets[channel_id]
+
+    async def send(self, channel, content=None, **kwargs):
+        await self._bucket(channel).acquire()
+        with DISCORD_SEND_DURATION.time(operation='send'):
+            return await channel.send(content, **kwargs)
+
+    def log_parts(self, header, text, filename, lang=''):
+        """Render a log as message parts, or as one attachment if it is long
+
+        Returns:
+            tuple: (parts, file) where file is a discord.File or None
+        """
+        if len(text) > self.attachment_threshold:
+            attachment = discord.File(io.BytesIO(text.encode('utf-8')), filename=filename)
+            return [f'{header} 📎 `{filename}` ({len(text)}文字)'], attachment
+        fence_overhead = len(lang) + 10
+        chunks = split_message(text, max_length=self.MESSAGE_LIMIT - len(header) - fence_overhead)
+        parts = [f'{header}\n```{lang}\n{chunks[0]}\n```']
+        parts += [f'```{lang}\n{chunk}\n```' for chunk in chunks[1:]]
+        return parts, None
+
+    async def send_batched(self, channel, parts, files=None, **kwargs):
+        """Pack parts into messages up to the length limit and send them in order"""
+        messages = []
+        current = ''
+        for part in parts:
+            if current and len(current) + 1 + len(part) > self.MESSAGE_LIMIT:
+                messages.append(current)
+                current = ''
+            if len(part) > self.MESSAGE_LIMIT:
+                messages.extend(split_message(part, max_length=self.MESSAGE_LIMIT - 10))
+                continue
+            current = f'{current}\n{part}' if current else part
+        if current:
+            messages.append(current)
+        files = [f for f in (files or []) if f]
+        sent = []
+        for i, content in enumerate(messages):
+            is_last = i == len(messages) - 1
+            if is_last and files:
+                sent.append(await self.send(channel, content, files=files, **kwargs))
+            else:
+                sent.append(await self.send(channel, content, **kwargs))
+        if not messages and files:
+            sent.append(await self.send(channel, files=files, **kwargs))
+        return sent
+
+message_dispatcher = MessageDispatcher(DISCORD_SEND_RATE, DISCORD_SEND_BURST, LOG_ATTACHMENT_THRESHOLD)
+
+web_app = FastAPI(title='ccbot', docs_url=None, redoc_url=None, openapi_url=None)
+
+@web_app.get('/metrics', response_class=PlainTextResponse)
+async def metrics_endpoint():
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+GALLERY_API_MAX_LIMIT = 100
+
+def gallery_api_response(request, build_id, make_body):
+    """JSON response with a weak ETag tied to the index build and the query"""
+    query_hash = hashlib.sha256(str(request.url.query).encode('utf-8')).hexdigest()[:16]
+    etag = f'W/"{build_id}-{query_hash}"'
+    headers = {'ETag': etag, 'Cache-Control': 'public, max-age=10'}
+    if request.headers.get('if-none-match') == etag:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(make_body(), headers=headers)
+
+@web_app.get('/api/gallery')
+async def gallery_api(request: Request, q: str = '', tag: str = '', author: str = '', channel: str = '',
+                      since: str = '', until: str = '', cursor: str = '', limit: int = 24):
+    """Paginated, filterable gallery rows; pass next_cursor back as cursor for the next page"""
+    index = await gallery_index.refresh()
+    limit = max(1, min(limit, GALLERY_API_MAX_LIMIT))
+    try:
+        page = index.query(q, tag, author, channel, since, until, cursor, limit)
+    except (ValueError, TypeError):
+        return JSONResponse({'error': 'invalid cursor'}, status_code=400)
+    return gallery_api_response(request, index.build_id, lambda: page)
+
+@web_app.get('/api/gallery/facets')
+async def gallery_facets_api(request: Request):
+    index = await gallery_index.refresh()
+    return gallery_api_response(request, index.build_id, index.facets)
+
+class StaticSite:
+    """Serves COMMAND_BASE_PATH (the projects and the gallery) from web_app
+
+    ETags are strong SHA-256 content hashes, cached by size and mtime.
+    Compressible files are pre-compressed once per content hash into
+    .static_cache (brotli when the optional brotli package is installed,
+    gzip otherwise). Copies are dropped when their source file changes, and
+    the oldest go once the cache holds more than max_cached files.
+    The v{n} snapshots and ?v=<hash> URLs are immutable.
+    Range requests and the ASGI pathsend extension are handled by
+    FileResponse. Dotfiles (databases, caches, checkpoints) are never served.
+    """
+
+    COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/manifest+json',
+                          'application/xml', 'image/svg+xml')
+
+    ENCODINGS = ('br', 'gzip')
+
+    def __init__(self, root, cache_dir, max_hashes=4096, max_cached=2048):
+        self.root = Path(root).resolve()
+        self.cache_dir = Path(cache_dir)
+        self.max_hashes = max_hashes
+        self.max_cached = max_cached
+        self._hashes = collections.OrderedDict()
+        self._created_since_prune = 0
+
+    def resolve(self, rel_path):
+        """Map a URL path to a file under root, or None if it must not be served"""
+        parts = [part for part in rel_path.split('/') if part]
+        if any(part.startswith('.') for part in parts):
+            return None
+        try:
+            path = self.root.joinpath(*parts).resolve()
+        except (OSError, ValueError):
+            return None
+        if path != self.root and self.root not in path.parents:
+            return None
+        return path
+
+    def content_hash(self, path, stat_result):
+        key = str(path)
+        cached = self._hashes.get(key)
+        if cached and cached[0] == stat_result.st_size and cached[1] == stat_result.st_mtime_ns:
+            self._hashes.move_to_end(key)
+            return cached[2]
+        digest = hash_file(path)
+        if cached and cached[2] != digest:
+            self.evict(cached[2])
+        self._hashes[key] = (stat_result.st_size, stat_result.st_mtime_ns, digest)
+        while len(self._hashes) > self.max_hashes:
+            self._hashes.popitem(last=False)
+        return digest
+
+    def variant_path(self, digest, encoding):
+        return self.cache_dir / f"{digest}.{'br' if encoding == 'br' else 'gz'}"
+
+    def evict(self, digest):
+        """Drop the compressed copies of content that a file no longer has"""
+        for encoding in self.ENCODINGS:
+            self.variant_path(digest, encoding).unlink(missing_ok=True)
+
+    def prune(self):
+        """Keep the newest max_cached compressed copies"""
+        try:
+            entries = [(entry.stat().st_mtime_ns, entry) for entry in self.cache_dir.iterdir() if entry.suffix in ('.br', '.gz')]
+        except OSError:
+            return
+        entries.sort(key=lambda item: item[0])
+        for _, entry in entries[:max(len(entries) - self.max_cached, 0)]:
+            entry.unlink(missing_ok=True)
+
+    def compressed_variant(self, path, digest, encoding):
+        """Path of the pre-compressed copy for this content, created on first use"""
+        variant = self.variant_path(digest, encoding)
+        if variant.exists():
+            return variant
+        data = path.read_bytes()
+        if encoding == 'br':
+            compressed = brotli.compress(data, quality=11)
+        else:
+            compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        temp_path = variant.with_name(f"{variant.name}.{uuid.uuid4().hex}.tmp")
+        temp_path.write_bytes(compressed)
+        os.replace(temp_path, variant)
+        self._created_since_prune += 1
+        if self._created_since_prune >= 64:
+            self._created_since_prune = 0
+            self.prune()
+        return variant
+
+    def cache_control(self, rel_path, request, digest):
+        parts = [part for part in rel_path.split('/') if part]
+        version = request.query_params.get('v')
+        if (len(parts) > 2 and is_version_dir(parts[1])) or (version and digest.startswith(version)):
+            return f'public, max-age={STATIC_IMMUTABLE_MAX_AGE}, immutable'
+        return f'public, max-age={STATIC_MAX_AGE}'
+
+    @staticmethod
+    def accepted_encodings(request):
+        accepted = set()
+        for item in request.headers.get('accept-encoding', '').split(','):
+            coding, _, params = item.strip().partition(';')
+            if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+                continue
+            accepted.add(coding.strip().lower())
+        return accepted
+
+    async def respond(self, request, rel_path):
+        path = self.resolve(rel_path)
+        if path is None or not path.exists():
+            return PlainTextResponse('Not Found', status_code=404)
+        if path.is_dir():
+            if not request.url.path.endswith('/'):
+                return RedirectResponse(request.url.replace(path=request.url.path + '/'), status_code=301)
+            if not (path / 'index.html').is_file():
+                if path.parent == self.root:
+                    for entry_dir in ('htdocs', 'public'):
+                        if (path / entry_dir / 'index.html').is_file():
+                            return RedirectResponse(request.url.replace(path=f"{request.url.path}{entry_dir}/"), status_code=302)
+                return PlainTextResponse('Not Found', status_code=404)
+            path = path / 'index.html'
+        stat_result = await asyncio.to_thread(path.stat)
+        digest = await asyncio.to_thread(self.content_hash, path, stat_result)
+        media_type = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+        headers = {
+            'ETag': f'"{digest}"',
+            'Cache-Control': self.cache_control(rel_path, request, digest),
+            'Vary': 'Accept-Encoding',
+        }
+        if_none_match = request.headers.get('if-none-match', '')
+        if if_none_match:
+            tags = {tag.strip().removeprefix('W/').strip('"') for tag in if_none_match.split(',')}
+            # Echo the validator the client holds, including -gzip/-br variants
+            matched = next((f'{digest}-{encoding}' for encoding in self.ENCODINGS if f'{digest}-{encoding}' in tags), None)
+            if matched or digest in tags or '*' in tags:
+                if matched:
+                    headers['ETag'] = f'"{matched}"'
+                return Response(status_code=304, headers=headers)
+        compressible = media_type.startswith(self.COMPRESSIBLE_TYPES) and stat_result.st_size >= STATIC_COMPRESS_MIN_SIZE
+        if compressible and 'range' not in request.headers:
+            accepted = self.accepted_encodings(request)
+            encoding = 'br' if brotli and 'br' in accepted else 'gzip' if 'gzip' in accepted else None
+            if encoding:
+                variant = await asyncio.to_thread(self.compressed_variant, path, digest, encoding)
+                variant_stat = await asyncio.to_thread(variant.stat)
+                if variant_stat.st_size < stat_result.st_size:
+                    headers['ETag'] = f'"{digest}-{encoding}"'
+                    headers['Content-Encoding'] = encoding
+                    return FileResponse(variant, media_type=media_type, headers=headers, stat_result=variant_stat)
+        return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
+
+STATIC_MOUNT_PATH = urlparse(PROJECT_BASE_URL).path.rstrip('/') if PROJECT_BASE_URL else '/projects'
+static_site = StaticSite(COMMAND_BASE_PATH, Path(COMMAND_BASE_PATH) / ".static_cache")
+
+if STATIC_MOUNT_PATH:
+    @web_app.get('/', include_in_schema=False)
+    async def static_root_redirect():
+        return RedirectResponse(f'{STATIC_MOUNT_PATH}/')
+
+@web_app.api_route(STATIC_MOUNT_PATH + '/{rel_path:path}', methods=['GET', 'HEAD'], include_in_schema=False)
+async def static_endpoint(request: Request, rel_path: str):
+    return await static_site.respond(request, rel_path)
+
+class EmbeddedServer(uvicorn.Server):
+    """uvicorn server sharing the bot's event loop; discord.py keeps signal handling"""
+
+    def install_signal_handlers(self):
+        pass
+
+    @contextlib.contextmanager
+    def capture_signals(self):
+        yield
+
+async def start_web_server():
+    """Serve web_app on HTTP_SERVER_PORT inside the bot's event loop"""
+    config = uvicorn.Config(web_app, host=HTTP_SERVER_HOST, port=HTTP_SERVER_PORT, log_level='warning', access_log=False)
+    server = EmbeddedServer(config)
+    log_info(f'🌐 HTTPサーバーを起動しました: http://{HTTP_SERVER_HOST}:{HTTP_SERVER_PORT}{STATIC_MOUNT_PATH}/ (metrics: /metrics)')
+    try:
+        await server.serve()
+    except Exception as e:
+        logger.error(f"HTTP server error: {e}", exc_info=True)
+
 @bot.event
 async def on_ready():
+    global alias_refresh_task, web_server_task, jobs_recovered
     log_info(f'{bot.user} がDiscordに接続しました!')
     log_info(f'コマンド実行ベースパス: {COMMAND_BASE_PATH}')
+    job_scheduler.start(run_scheduled_job)
+    if not jobs_recovered:
+        jobs_recovered = True
+        try:
+            await recover_interrupted_jobs()
+        except Exception as e:
+            logger.error(f"Job recovery failed: {e}", exc_info=True)
+        try:
+            pruned = await job_journal.prune(JOB_JOURNAL_RETENTION_DAYS)
+            if pruned:
+                logger.info(f"Pruned {pruned} finished jobs older than {JOB_JOURNAL_RETENTION_DAYS} days from the journal")
+        except Exception as e:
+            logger.warning(f"Job journal prune failed: {e}")
+    await thumbnail_browser_pool.start()
     if PROMPT_ALIAS_SPREADSHEET_ID:
-        success, message = load_prompt_aliases_from_spreadsheet(PROMPT_ALIAS_SPREADSHEET_ID, force=True)
+        success, message = await load_prompt_aliases_from_spreadsheet(PROMPT_ALIAS_SPREADSHEET_ID, force=True)
         if success:
             log_info(f'✅ {message}')
         else:
             log_info(f'⚠️ {message}')
+    if alias_refresh_task is None or alias_refresh_task.done():
+        alias_refresh_task = asyncio.create_task(prompt_alias_refresh_loop())
+    if HTTP_SERVER_PORT and (web_server_task is None or web_server_task.done()):
+        web_server_task = asyncio.create_task(start_web_server())
 
 @bot.event
 async def on_message(message):
@@ -747,7 +3024,7 @@ async def on_message(message):
     match = re.search(spreadsheet_pattern, message.content)
     if match:
         spreadsheet_url = match.group(0)
-        success, msg = load_prompt_aliases_from_spreadsheet(spreadsheet_url, force=True)
+        success, msg = await load_prompt_aliases_from_spreadsheet(spreadsheet_url, force=True)
         if success:
             await message.add_reaction('✅')
             await message.channel.send(f'✅ {msg}')
@@ -847,26 +3124,19 @@ async def claude_execute(ctx, *, full_input: str = None):
             url_detected = True
             project_path_check = Path(COMMAND_BASE_PATH) / project_id
             if project_path_check.exists():
-                files = list(project_path_check.rglob('*'))
-                files = filter_project_files(files, project_path_check)
-                if files:
+                manifest = await asyncio.to_thread(scan_project_files, project_path_check, True)
+                if manifest.files:
                     is_existing_project = True
             logger.info(f"Pattern: url_update | ID: {project_id} | Existing: {is_existing_project} | Prompt: {prompt[:80]}")
         else:
             prompt = full_input
             project_id = str(uuid.uuid4())[:8]
             logger.info(f"Pattern: long_prompt | ID: {project_id} | Prompt: {prompt[:80]}")
-    if PROMPT_ALIAS_SPREADSHEET_ID:
-        success, message = load_prompt_aliases_from_spreadsheet(PROMPT_ALIAS_SPREADSHEET_ID, silent=True)
-        if success:
-            logger.debug(f"Prompt aliases ready: {len(prompt_aliases)} tags")
-        else:
-            logger.warning(f"⚠️ Failed to reload aliases: {message}")
+    refresh_prompt_aliases_in_background()
     prompt = prompt.replace('　', ' ')
     channel_name = ctx.channel.name if hasattr(ctx.channel, 'name') else None
-    all_mentioned_prompt_tags = re.findall(r'#(\w+)', prompt)
+    unknown_prompt_tags = unknown_prompt_tags_in(prompt)
     prompt, _, _, replaced_tags, auto_appended = replace_prompt_aliases(prompt, ctx.channel.id, channel_name)
-    unknown_prompt_tags = [tag for tag in all_mentioned_prompt_tags if tag not in prompt_aliases]
     thinking_msg = '🤔 タスクを受け付けました。作成には数分程度かかります...'
     if is_existing_project:
         thinking_msg += f'\n♻️ 既存プロジェクト `{project_id}` を更新します'
@@ -892,19 +3162,100 @@ async def claude_execute(ctx, *, full_input: str = None):
             tag_summary.append(f"Unknown: {', '.join(unknown_prompt_tags)}")
         if tag_summary:
             logger.info(f"Tags applied | {' | '.join(tag_summary)}")
-    original_message_ref = ctx.message
+    thumbnail_mode = resolve_thumbnail_mode(ctx.channel.id, channel_name, replaced_tags + auto_appended)
+    priority = resolve_job_priority(ctx, replaced_tags + auto_appended)
+    job = ClaudeJob(ctx, project_id, prompt, coalescable=url_detected, thumbnail_mode=thumbnail_mode, priority=priority)
+    try:
+        position = job_scheduler.submit(job)
+    except UserQuotaExceededError as e:
+        JOBS_TOTAL.inc(status='rejected')
+        logger.warning(f"REQUEST_REJECTED | User quota ({e.limit}) | User: {job.user_id} | ID: {project_id}")
+        try:
+            await ctx.message.add_reaction('❌')
+        except Exception as reaction_error:
+            logger.warning(f"Failed to add reaction: {reaction_error}")
+        if e.limit == 'hourly':
+            await ctx.send(f'🚫 1時間あたりの上限（{job_scheduler.max_per_user_hour} 件）に達しました。約{max(1, round(e.retry_after / 60))}分後に再度お試しください。')
+        else:
+            await ctx.send(f'🚫 待機中のリクエストが上限（{job_scheduler.max_queued_per_user} 件）に達しています。完了を待ってから再度お試しください。')
+        return
+    except JobQueueFullError:
+        JOBS_TOTAL.inc(status='rejected')
+        logger.warning(f"REQUEST_REJECTED | Queue full ({job_scheduler.max_queued}) | ID: {project_id}")
+        try:
+            await ctx.message.add_reaction('❌')
+        except Exception as e:
+            logger.warning(f"Failed to add reaction: {e}")
+        await ctx.send(f'🚫 現在混み合っています（待機中 {job_scheduler.max_queued} 件）。しばらくしてから再度お試しください。')
+        return
+    try:
+        await job_journal.record(job.coalesced_into or job)
+    except Exception as e:
+        logger.warning(f"Failed to journal job: {e}")
     try:
-        await original_message_ref.add_reaction('⏳')
+        await ctx.message.add_reaction('⏳')
         logger.debug("Added ⏳ reaction to original message")
     except Exception as e:
         logger.warning(f"Failed to add reaction: {e}")
+    if job.coalesced_into:
+        thinking_msg += f'\n🔗 待機中の同じプロジェクトへのリクエストとまとめて実行します（{len(job.coalesced_into.prompts)}件）'
+    elif any(running.project_id == project_id for running in job_scheduler.running):
+        thinking_msg += f'\n🔒 プロジェクト `{project_id}` は処理中のため、完了後に実行します'
+    elif sum(1 for running in job_scheduler.running if running.user_id == job.user_id) >= job_scheduler.max_running_per_user:
+        thinking_msg += '\n👤 実行中のあなたのリクエストが完了してから開始します'
+    if (job.coalesced_into or job).priority != 'normal':
+        thinking_msg += f'\n⚡ 優先度: {(job.coalesced_into or job).priority}'
+    if position > 0:
+        wait_seconds = job_scheduler.estimate_start_delay(job)
+        start_at = datetime.fromtimestamp(time.time() + wait_seconds).strftime('%H:%M')
+        thinking_msg += f'\n🕒 待機順: {position}番目（開始予定 {start_at} 頃, 約{max(1, round(wait_seconds / 60))}分後）'
+    try:
+        job.status_msg = await ctx.send(thinking_msg)
+    except Exception as e:
+        logger.warning(f"Failed to send queue status: {e}")
+    finally:
+        job.status_ready.set()
+
+async def run_scheduled_job(job):
+    """Worker entry point; !retry jobs skip the Claude run"""
+    if isinstance(job, RetryJob):
+        await retry_post_processing(job)
+    else:
+        await run_claude_job(job)
+
+async def run_claude_job(job):
+    """Run a queued !claude job inside a request trace span"""
+    try:
+        await job_journal.record(job, 'running')
+    except Exception as e:
+        logger.warning(f"Failed to journal job start: {e}")
+    with trace_span(
+        'request',
+        trace_id=job.request_id,
+        project_id=job.project_id,
+        user_id=job.user_id,
+        priority=job.priority,
+        prompts=len(job.prompts),
+        queue_wait_s=round(job.started_at - job.enqueued_at, 1) if job.started_at else None
+    ):
+        await process_claude_job(job)
+
+async def process_claude_job(job):
+    """Claude Code, summary, thumbnail and gallery for one job"""
+    ctx = job.ctx
+    project_id = job.project_id
+    prompt = job.prompt
     project_path = Path(COMMAND_BASE_PATH) / project_id
     backup_path = None
-    if project_path.exists():
-        files = list(project_path.rglob('*'))
-        files = filter_project_files(files, project_path)
-        if files:
-            backup_path = backup_project_version(project_path)
+    if 'backup' in job.completed_stages:
+        backup_path = Path(job.stage_data['backup_path']) if job.stage_data.get('backup_path') else None
+    else:
+        if project_path.exists():
+            manifest = await asyncio.to_thread(scan_project_files, project_path, True)
+            if manifest.files:
+                with pipeline_stage('backup'):
+                    backup_path = await asyncio.to_thread(backup_project_version, project_path)
+        await job_journal.mark_stage(job, 'backup', backup_path=str(backup_path) if backup_path else None)
     project_path.mkdir(parents=True, exist_ok=True)
     project_url = f'{PROJECT_BASE_URL.rstrip("/")}/{project_id}' if PROJECT_BASE_URL else f'/projects/{project_id}'
     seo_instructions = """
@@ -923,80 +3274,193 @@ async def claude_execute(ctx, *, full_input: str = None):
 """
     enhanced_prompt = prompt + seo_instructions
     escaped_prompt = enhanced_prompt.replace('\\', '\\\\').replace('"', '\\"').replace('$', '\\$').replace('`', '\\`')
-    claude_command = f'claude -p --dangerously-skip-permissions "{escaped_prompt}"'
+    output_flags = ' --verbose --output-format stream-json' if CLAUDE_STREAM_JSON else ''
+    log_path = CLAUDE_LOG_DIR / f"{project_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+    author_info = {
+        "user_id": str(ctx.author.id),
+        "username": ctx.author.name,
+        "display_name": ctx.author.display_name,
+        "discriminator": ctx.author.discriminator,
+        "channel_id": str(ctx.channel.id),
+        "channel_name": ctx.channel.name if hasattr(ctx.channel, 'name') else "DM",
+        "guild_id": str(ctx.guild.id) if ctx.guild else None,
+        "guild_name": ctx.guild.name if ctx.guild else None
+    }
+    checkpoints = StageCheckpoints(project_path)
     try:
-        stdout, stderr, returncode = await execute_command_with_timeout(
-            claude_command,
-            str(project_path),
-            timeout=600
-        )
-        has_html = False
-        for item in project_path.rglob('*.html'):
-            if item.is_file():
-                has_html = True
-                break
-        project_summary = await generate_project_summary_with_ai(project_path, prompt, stdout)
-        thumbnail_url = await generate_thumbnail_with_progress(project_summary, prompt, project_path)
-        author_info = {
-            "user_id": str(ctx.author.id),
-            "username": ctx.author.name,
-            "display_name": ctx.author.display_name,
-            "discriminator": ctx.author.discriminator,
-            "channel_id": str(ctx.channel.id),
-            "channel_name": ctx.channel.name if hasattr(ctx.channel, 'name') else "DM",
-            "guild_id": str(ctx.guild.id) if ctx.guild else None,
-            "guild_name": ctx.guild.name if ctx.guild else None
-        }
-        if has_html:
-            await update_html_meta_tags(project_path, project_summary, project_url, thumbnail_url)
-        await save_to_csv_gallery(project_id, project_summary, prompt, thumbnail_url, author_info)
-        await update_reaction(original_message_ref, '⏳', '✅')
-        logger.info(f"REQUEST_COMPLETE | ID: {project_id}")
-        response = f'✅ [{project_summary}]({project_url})\n'
-        if backup_path:
-            response += f'💾 旧バージョンを `{backup_path.name}` に保存しました\n'
-        main_msg = await ctx.send(response)
-        thread = await main_msg.create_thread(
-            name=f"詳細結果: {project_summary[:80]}",
-            auto_archive_duration=1440
-        )
-        thread_link = f"https://discord.com/channels/{ctx.guild.id}/{thread.id}"
-        await main_msg.edit(content=response + f'\n📋 [詳細ログ]({thread_link})')
+        if 'claude_run' in job.completed_stages:
+            # Resumed after a restart: Claude already ran, continue from its saved output
+            stdout = job.stage_data.get('stdout', '')
+            stderr = job.stage_data.get('stderr', '')
+            returncode = job.stage_data.get('returncode')
+            log_path = Path(job.stage_data.get('log_path', log_path))
+        else:
+            checkpoints.start(
+                request_id=job.request_id,
+                prompt=prompt,
+                project_url=project_url,
+                thumbnail_mode=job.thumbnail_mode,
+                author_info=author_info
+            )
+            parser = ClaudeStreamParser()
+            reporter = None
+            # An idle worker picks the job up before claude_execute has posted its status message
+            try:
+                await asyncio.wait_for(job.status_ready.wait(), timeout=STATUS_READY_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Status message not ready for {project_id}; running without progress thread")
+            if job.status_msg:
+                try:
+                    progress_thread = await job.status_msg.create_thread(
+                        name=f"進捗: {project_id}",
+                        auto_archive_duration=60
+                    )
+                    reporter = ProgressReporter(progress_thread, f'⚙️ Claude Code 実行中: `{project_id}`')
+                    reporter.start()
+                except Exception as e:
+                    logger.warning(f"Progress thread unavailable: {e}")
+
+            def on_line(stream_name, line):
+                if stream_name == 'stdout' and CLAUDE_STREAM_JSON:
+                    progress = parser.feed(line)
+                else:
+                    progress = line.strip()[:150] or None
+                if progress and reporter:
+                    reporter.add(progress)
 
-        # Always show execution info
-        execution_info = f"""📊 **実行情報:**
+            session_id = resumable_claude_session(project_id)
+            if session_id and reporter:
+                reporter.add('🔁 前回のセッションを再開して実行します')
+            try:
+                while True:
+                    resume_flag = f' --resume {session_id}' if session_id else ''
+                    claude_command = f'claude -p --dangerously-skip-permissions{resume_flag}{output_flags} "{escaped_prompt}"'
+                    with pipeline_stage('claude_run', resumed=bool(session_id)):
+                        stdout, stderr, returncode = await execute_command_streaming(
+                            claude_command,
+                            str(project_path),
+                            timeout=600,
+                            log_path=log_path,
+                            on_line=on_line
+                        )
+                    if session_id and parser.result_text is None and claude_session_missing(stdout, stderr, returncode):
+                        # The CLI no longer has this session; fall back to a cold start
+                        logger.warning(f"Claude session {session_id} could not be resumed (rc={returncode}), starting cold")
+                        update_project_metadata(project_id, claude_session_id=None)
+                        if reporter:
+                            reporter.add('♻️ 前回のセッションを再開できないため、新しいセッションで実行します')
+                        session_id = None
+                        parser = ClaudeStreamParser()
+                        continue
+                    break
+            finally:
+                if reporter:
+                    await reporter.stop()
+            if CLAUDE_STREAM_JSON and parser.result_text is not None:
+                stdout = parser.result_text
+            if parser.session_id and returncode == 0 and not parser.is_error:
+                update_project_metadata(project_id, claude_session_id=parser.session_id, claude_session_updated_at=time.time())
+                logger.info(f"Claude session {'resumed' if session_id else 'started'}: {parser.session_id}")
+            checkpoints.mark_done('claude_run', {'returncode': returncode, 'log_path': str(log_path)})
+            await job_journal.mark_stage(
+                job, 'claude_run', stdout=stdout, stderr=stderr, returncode=returncode, log_path=str(log_path)
+            )
+        manifest = await asyncio.to_thread(scan_project_files, project_path, True)
+        has_html = bool(manifest.html_files)
+        project_summary, tags = await run_stage(checkpoints, 'summary', generate_summary_stage, project_path, prompt)
+        # Tags, thumbnail, OGP and gallery run in the background while the link is posted
+        post_task = asyncio.create_task(run_post_processing(
+            project_id, project_path, project_summary, tags, prompt, project_url,
+            has_html, author_info, job.thumbnail_mode
+        ))
+        try:
+            for message in job.messages:
+                await update_reaction(message, '⏳', '✅')
+            response = f'✅ [{project_summary}]({project_url})\n'
+            if backup_path:
+                response += f'💾 旧バージョンを `{backup_path.name}` に保存しました\n'
+            if job.followers:
+                response += f'🔗 {len(job.prompts)}件の指示をまとめて反映しました\n'
+            main_msg = await ctx.send(response)
+            thread = await main_msg.create_thread(
+                name=f"詳細結果: {project_summary[:80]}",
+                auto_archive_duration=1440
+            )
+            thread_link = f"https://discord.com/channels/{ctx.guild.id}/{thread.id}"
+            await main_msg.edit(content=response + f'\n📋 [詳細ログ]({thread_link})')
+
+            # Always show execution info
+            execution_info = f"""📊 **実行情報:**
 • **プロジェクトID:** `{project_id}`
 • **終了コード:** `{returncode}`
 • **HTMLファイル:** {'✅ あり' if has_html else '❌ なし'}
-• **生成ファイル数:** {len(list(project_path.rglob('*')))}"""
-        await thread.send(execution_info, silent=True)
+• **生成ファイル数:** {len(manifest.files)}
+• **全ログ:** `{log_path}`"""
+            parts = [execution_info]
+            attachments = []
+
+            # Always show stdout
+            stdout_parts, stdout_file = message_dispatcher.log_parts(
+                '**Claude Code 実行ログ:**', stdout or '(出力なし)', f'{project_id}_stdout.txt'
+            )
+            parts += stdout_parts
+            attachments.append(stdout_file)
 
-        # Always show stdout
-        if stdout:
-            stdout_chunks = split_message(stdout, max_length=1800)
-            for chunk in stdout_chunks:
-                await thread.send(f'**Claude Code 実行ログ:**\n```\n{chunk}\n```', silent=True)
+            # Always show stderr if present
+            if stderr:
+                stderr_parts, stderr_file = message_dispatcher.log_parts(
+                    '**エラー出力:**', stderr, f'{project_id}_stderr.txt'
+                )
+                parts += stderr_parts
+                attachments.append(stderr_file)
+
+            # Show file list
+            if not has_html:
+                parts.append(await list_project_files(project_path))
+            await message_dispatcher.send_batched(thread, parts, attachments, silent=True)
+        finally:
+            post_error = (await asyncio.gather(post_task, return_exceptions=True))[0]
+        if isinstance(post_error, Exception):
+            failed_stages = checkpoints.failed_stages()
+            logger.error(f"Post-processing error: {type(post_error).__name__}: {post_error} | Stages: {failed_stages}")
+            annotate_span(error=f"{type(post_error).__name__}: {post_error}", failed_stages=failed_stages)
+            for message in job.messages:
+                await update_reaction(message, '✅', '⚠️')
+            await message_dispatcher.send(
+                thread,
+                f'⚠️ サムネイル・ギャラリーの更新に失敗しました: {post_error}\n'
+                f'🔁 `!retry {project_id}` で失敗した段階だけを再実行できます',
+                silent=True
+            )
+            JOBS_TOTAL.inc(status='degraded')
+            await job_journal.mark_degraded(job, failed_stages)
+            logger.info(f"REQUEST_DEGRADED | ID: {project_id} | Stages: {failed_stages}")
         else:
-            await thread.send('**Claude Code 実行ログ:**\n```\n(出力なし)\n```', silent=True)
-
-        # Always show stderr if present
-        if stderr:
-            stderr_chunks = split_message(stderr, max_length=1800)
-            for chunk in stderr_chunks:
-                await thread.send(f'**エラー出力:**\n```\n{chunk}\n```', silent=True)
-
-        # Show file list
-        if not has_html:
-            file_list = await list_project_files(project_path)
-            await thread.send(file_list, silent=True)
+            JOBS_TOTAL.inc(status='success')
+            await job_journal.mark_state(job.request_id, 'completed')
+            logger.info(f"REQUEST_COMPLETE | ID: {project_id}")
     except Exception as e:
-        await update_reaction(original_message_ref, '⏳', '❌')
+        for message in job.messages:
+            await update_reaction(message, '⏳', '❌')
         error_type = type(e).__name__
         error_msg = str(e)
+        JOBS_TOTAL.inc(status='error')
+        annotate_span(error=f"{error_type}: {error_msg}")
+        try:
+            if checkpoints.is_done('claude_run'):
+                # Claude's work is kept; !retry can finish the failed stages
+                await job_journal.mark_degraded(job, checkpoints.failed_stages())
+            else:
+                await job_journal.mark_state(job.request_id, 'failed')
+        except Exception as journal_error:
+            logger.warning(f"Failed to journal job failure: {journal_error}")
         logger.error(f"Claude Code execution error: {error_type}: {error_msg}", exc_info=True)
 
         # Send error message to channel
-        await ctx.send(content=f'❌ エラーが発生しました: {error_msg}')
+        error_notice = f'❌ エラーが発生しました: {error_msg}'
+        if checkpoints.is_done('claude_run'):
+            error_notice += f'\n🔁 Claude Code の実行結果は保存されています。`!retry {project_id}` で失敗した段階から再実行できます'
+        await ctx.send(content=error_notice)
 
         # Create thread for detailed error logs
         try:
@@ -1012,32 +3476,34 @@ async def claude_execute(ctx, *, full_input: str = None):
 • **エラー種類:** `{error_type}`
 • **エラーメッセージ:** {error_msg}
 • **プロジェクトパス:** `{project_path}`"""
-            await error_thread.send(error_summary, silent=True)
+            parts = [error_summary]
+            attachments = []
 
             # Show Claude Code execution logs if available
             if 'stdout' in locals() and stdout:
-                stdout_chunks = split_message(stdout, max_length=1800)
-                await error_thread.send('**Claude Code 実行ログ (stdout):**', silent=True)
-                for chunk in stdout_chunks:
-                    await error_thread.send(f'```\n{chunk}\n```', silent=True)
+                stdout_parts, stdout_file = message_dispatcher.log_parts(
+                    '**Claude Code 実行ログ (stdout):**', stdout, f'{project_id}_stdout.txt'
+                )
+                parts += stdout_parts
+                attachments.append(stdout_file)
             else:
-                await error_thread.send('**Claude Code 実行ログ (stdout):**\n```\n(ログなし - Claude Codeが実行される前にエラーが発生した可能性があります)\n```', silent=True)
+                parts.append('**Claude Code 実行ログ (stdout):**\n```\n(ログなし - Claude Codeが実行される前にエラーが発生した可能性があります)\n```')
 
             if 'stderr' in locals() and stderr:
-                stderr_chunks = split_message(stderr, max_length=1800)
-                await error_thread.send('**エラー出力 (stderr):**', silent=True)
-                for chunk in stderr_chunks:
-                    await error_thread.send(f'```\n{chunk}\n```', silent=True)
+                stderr_parts, stderr_file = message_dispatcher.log_parts(
+                    '**エラー出力 (stderr):**', stderr, f'{project_id}_stderr.txt'
+                )
+                parts += stderr_parts
+                attachments.append(stderr_file)
 
             if 'returncode' in locals():
-                await error_thread.send(f'**終了コード:** `{returncode}`', silent=True)
+                parts.append(f'**終了コード:** `{returncode}`')
 
             # Show generated files
             try:
-                file_list = await list_project_files(project_path)
-                await error_thread.send(file_list, silent=True)
+                parts.append(await list_project_files(project_path))
             except Exception as list_error:
-                await error_thread.send(f'ファイル一覧取得エラー: {str(list_error)}', silent=True)
+                parts.append(f'ファイル一覧取得エラー: {str(list_error)}')
 
             # Diagnostic information
             diagnostic = f"""🔍 **診断情報:**
@@ -1052,16 +3518,18 @@ async def claude_execute(ctx, *, full_input: str = None):
 1. 上記の実行ログを確認
 2. プロンプトをより具体的に修正
 3. 必要に応じて `!cmd {project_id} ls -la` でディレクトリを確認"""
-            await error_thread.send(diagnostic, silent=True)
+            parts.append(diagnostic)
 
             # Get full stack trace
             import traceback
             stack_trace = traceback.format_exc()
             if stack_trace and stack_trace != 'NoneType: None\n':
-                trace_chunks = split_message(stack_trace, max_length=1800)
-                await error_thread.send('**スタックトレース:**', silent=True)
-                for chunk in trace_chunks:
-                    await error_thread.send(f'```python\n{chunk}\n```', silent=True)
+                trace_parts, trace_file = message_dispatcher.log_parts(
+                    '**スタックトレース:**', stack_trace, f'{project_id}_traceback.txt', lang='python'
+                )
+                parts += trace_parts
+                attachments.append(trace_file)
+            await message_dispatcher.send_batched(error_thread, parts, attachments, silent=True)
 
             thread_link = f"https://discord.com/channels/{ctx.guild.id}/{error_thread.id}"
             await error_thread_msg.edit(content=f'❌ エラー詳細: {error_type}\n📋 [詳細ログ]({thread_link})')
@@ -1069,6 +3537,68 @@ async def claude_execute(ctx, *, full_input: str = None):
             logger.error(f"Failed to create error thread: {str(thread_error)}")
             await ctx.send(f'⚠️ エラーログの作成に失敗しました: {str(thread_error)}')
 
+@bot.command(name='retry')
+async def retry_stages(ctx, project_id_or_url: str = None):
+    """
+    失敗した後処理（要約・サムネイル・ギャラリー・OGP）だけを再実行
+    使い方: !retry [プロジェクトID/URL]
+    """
+    if project_id_or_url is None:
+        await ctx.send('❌ エラー: プロジェクトIDまたはURLが必要です。\n使い方: `!retry [プロジェクトID/URL]`')
+        return
+    project_id = extract_project_id_from_url(project_id_or_url)
+    project_path = Path(COMMAND_BASE_PATH) / project_id
+    checkpoints = StageCheckpoints(project_path)
+    context = checkpoints.context()
+    if not context or not checkpoints.is_done('claude_run'):
+        await ctx.send(f'❌ `{project_id}` には再実行できる Claude Code の実行結果がありません。`!claude` で実行してください。')
+        return
+    job = RetryJob(ctx, project_id)
+    try:
+        position = job_scheduler.submit(job)
+    except UserQuotaExceededError:
+        await ctx.send('🚫 リクエストの上限に達しています。しばらくしてから再度お試しください。')
+        return
+    except JobQueueFullError:
+        await ctx.send(f'🚫 現在混み合っています（待機中 {job_scheduler.max_queued} 件）。しばらくしてから再度お試しください。')
+        return
+    if position > 0 or any(running.project_id == project_id for running in job_scheduler.running):
+        await ctx.send(f'⏳ `{project_id}` の後処理の再実行を受け付けました。実行中の処理の完了後に開始します')
+
+async def retry_post_processing(job):
+    """Run the failed post-processing stages of a !retry job"""
+    ctx = job.ctx
+    project_id = job.project_id
+    project_path = Path(COMMAND_BASE_PATH) / project_id
+    checkpoints = StageCheckpoints(project_path)
+    context = checkpoints.context()
+    # A !claude run queued ahead of the retry may have replaced the checkpoints
+    if not context or not checkpoints.is_done('claude_run'):
+        await ctx.send(f'❌ `{project_id}` には再実行できる Claude Code の実行結果がありません。`!claude` で実行してください。')
+        return
+    pending_stages = [stage for stage in STAGE_RETRY_POLICIES if not checkpoints.is_done(stage)]
+    await ctx.send(f'🔁 `{project_id}` の後処理を再実行します: {", ".join(pending_stages) or "なし"}')
+    with trace_span('retry', project_id=project_id, user_id=job.user_id, stages=pending_stages):
+        try:
+            manifest = await asyncio.to_thread(scan_project_files, project_path, True)
+            prompt = context['prompt']
+            project_summary, tags = await run_stage(checkpoints, 'summary', generate_summary_stage, project_path, prompt)
+            await run_post_processing(
+                project_id, project_path, project_summary, tags, prompt, context['project_url'],
+                bool(manifest.html_files), context['author_info'], context.get('thumbnail_mode')
+            )
+        except Exception as e:
+            annotate_span(error=f"{type(e).__name__}: {e}")
+            logger.error(f"Retry failed for {project_id}: {type(e).__name__}: {e}", exc_info=True)
+            await ctx.send(f'❌ 再実行に失敗しました（{", ".join(checkpoints.failed_stages()) or "不明な段階"}）: {e}')
+            return
+    logger.info(f"RETRY_COMPLETE | ID: {project_id} | Stages: {pending_stages}")
+    try:
+        await job_journal.resolve_degraded(project_id)
+    except Exception as e:
+        logger.warning(f"Failed to journal retry result: {e}")
+    await ctx.send(f'✅ [{project_summary}]({context["project_url"]})\n🔁 後処理の再実行が完了しました')
+
 @bot.command(name='load_aliases')
 async def load_aliases(ctx, spreadsheet_url: str = None):
     """
@@ -1078,7 +3608,7 @@ async def load_aliases(ctx, spreadsheet_url: str = None):
     if spreadsheet_url is None:
         await ctx.send('❌ エラー: スプレッドシートURLが必要です。\n使い方: `!load_aliases [スプレッドシートURL]`')
         return
-    success, message = load_prompt_aliases_from_spreadsheet(spreadsheet_url, force=True)
+    success, message = await load_prompt_aliases_from_spreadsheet(spreadsheet_url, force=True)
     if success:
         await ctx.send(f'✅ {message}')
     else:
@@ -1113,6 +3643,8 @@ async def help_bot(ctx):
 • `!claude [プロンプト]` - 新規プロジェクト作成
 • `!claude [URL] [プロンプト]` - 既存プロジェクト更新
 
+• `!retry [プロジェクトID/URL]` - 失敗した後処理だけを再実行
+
 **⚙️ コマンド実行**
 • `!cmd [プロジェクトID/URL] [コマンド]` - シェルコマンド実行
 
@@ -1148,7 +3680,25 @@ async def cmd_error(ctx, error):
 async def claude_error(ctx, error):
     await handle_command_error(ctx, error, '`!claude [プロンプト]` または `!claude [プロジェクトID/URL] [プロンプト]`')
 
+@retry_stages.error
+async def retry_error(ctx, error):
+    await handle_command_error(ctx, error, '`!retry [プロジェクトID/URL]`')
+
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'trace-report':
+        # Usage: python ccbot.py trace-report [traces.jsonl] [--since 2025-01-01T00:00]
+        args = sys.argv[2:]
+        since = None
+        if '--since' in args:
+            index = args.index('--since')
+            since = args[index + 1] if index + 1 < len(args) else None
+            args = args[:index] + args[index + 2:]
+        print(trace_report(Path(args[0]) if args else TRACE_LOG_PATH, since=since))
+        exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == 'thumbnail-variants':
+        # Usage: python ccbot.py thumbnail-variants
+        print(backfill_thumbnail_variants())
+        exit(0)
     if not TOKEN:
         log_info('❌ エラー: DISCORD_BOT_TOKENが設定されていません')
         log_info('.envファイルにトークンを設定してください')